@@ -9,13 +9,19 @@ used for the StratusLab Libcloud configuration.
 
 import os
 import paramiko
-import time
+import threading
+import uuid
+
+from StringIO import StringIO
 
 try:
     from DIRAC import gLogger, S_OK, S_ERROR
 except:
     from stratuslab.dirac.DiracMock import gLogger, S_OK, S_ERROR
 
+from stratuslab.dirac.context_bundle import get_bundle
+from stratuslab.dirac.tracing import NULL_SPAN
+
 
 class DiracSshContext (object):
 
@@ -36,61 +42,121 @@ class DiracSshContext (object):
                          vmCvmfsContextURL,
                          vmDiracContextURL,
                          siteName,
-                         cpuTime):
+                         cpuTime,
+                         span=None):
+        # the optional span (see tracing.py) receives one child span
+        # for each step of the contextualization
+        span = span or NULL_SPAN
+
         # the contextualization using ssh needs the VM to be ACTIVE, so VirtualMachineContextualization
         # check status and launch contextualize_VMInstance
 
         # 1) copy the necesary files
 
-        # prepare paramiko sftp client
+        # prepare paramiko transport; the same authenticated connection is
+        # used for the file transfer and for running the contextualization script
+        step = span.child('transfer', publicIP=publicIP)
         try:
             privatekeyfile = os.path.expanduser('~/.ssh/id_rsa')
             mykey = paramiko.RSAKey.from_private_key_file(privatekeyfile)
             sshusername = 'root'
             transport = paramiko.Transport(( publicIP, 22 ))
             transport.connect(username=sshusername, pkey=mykey)
-            sftp = paramiko.SFTPClient.from_transport(transport)
         except Exception, errmsg:
-            return S_ERROR("Can't open sftp conection to %s: %s" % ( publicIP, errmsg ))
+            step.finish(error=errmsg)
+            return S_ERROR("Can't open ssh conection to %s: %s" % ( publicIP, errmsg ))
 
-        # scp VM cert/key
+        # VM cert/key and the contextualize-script are sent in a single
+        # archive (shared by all of the VMs) without the files that the
+        # VM already has
         putCertPath = "/root/vmservicecert.pem"
         putKeyPath = "/root/vmservicekey.pem"
+        putScriptPath = "/root/contextualize-script.bash"
         try:
-            sftp.put(vmCertPath, putCertPath)
-            sftp.put(vmKeyPath, putKeyPath)
-            # while the ssh.exec_command is asyncronous request I need to put on the VM the contextualize-script to ensure the file existence before exec
-            sftp.put(vmContextualizeScriptPath, '/root/contextualize-script.bash')
-        except Exception, errmsg:
-            return S_ERROR(errmsg)
-        finally:
-            sftp.close()
-            transport.close()
+            bundle = get_bundle([(vmCertPath, putCertPath),
+                                 (vmKeyPath, putKeyPath),
+                                 (vmContextualizeScriptPath, putScriptPath)])
 
-            # giving time sleep asyncronous sftp
-        time.sleep(5)
+            _status, output = DiracSshContext._run(transport, bundle.checksum_command())
+            needed = bundle.needed(bundle.parse_checksums(output))
+            step.set_attribute('files', len(needed))
 
+            if needed:
+                archivePath = '/root/.dirac-context-%s.tar.gz' % uuid.uuid4().hex
+                sftp = paramiko.SFTPClient.from_transport(transport)
+                try:
+                    sftp.putfo(StringIO(bundle.archive(needed)), archivePath)
+                finally:
+                    sftp.close()
 
-        #2)  prepare paramiko ssh client
-        try:
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(publicIP, username=sshusername, port=22, pkey=mykey)
+                # the files are complete on the VM once tar has exited
+                status, output = DiracSshContext._run(transport, bundle.extract_command(archivePath))
+                if status != 0:
+                    raise IOError('extraction of the context files failed (%s): %s' % (status, output))
         except Exception, errmsg:
-            return S_ERROR("Can't open ssh conection to %s: %s" % ( publicIP, errmsg ))
+            step.finish(error=errmsg)
+            transport.close()
+            return S_ERROR("Can't copy the context files to %s: %s" % ( publicIP, errmsg ))
+        step.finish()
 
-        #3) Run the DIRAC contextualization orchestator script:
+        #2) Run the DIRAC contextualization orchestator script:
 
+        step = span.child('contextualize_script', publicIP=publicIP)
         try:
-            remotecmd = "/bin/bash /root/contextualize-script.bash \'%s\' \'%s\' \'%s\' \'%s\' \'%s\' \'%s\' \'%s\' \'%s\' \'%s\' \'%s\' \'%s\' \'%s\' \'%s\' \'%s\'"
-            remotecmd = remotecmd % ( uniqueId, putCertPath, putKeyPath, vmRunJobAgentURL,
+            remotecmd = "/bin/bash %s \'%s\' \'%s\' \'%s\' \'%s\' \'%s\' \'%s\' \'%s\' \'%s\' \'%s\' \'%s\' \'%s\' \'%s\' \'%s\' \'%s\'"
+            remotecmd = remotecmd % ( putScriptPath, uniqueId, putCertPath, putKeyPath, vmRunJobAgentURL,
                                       vmRunVmMonitorAgentURL, vmRunVmUpdaterAgentURL, vmRunLogAgentURL,
                                       vmCvmfsContextURL, vmDiracContextURL, cvmfs_http_proxy, siteName, cloudDriver,
                                       cpuTime, vmStopPolicy )
             print "remotecmd"
             print remotecmd
-            _stdin, _stdout, _stderr = ssh.exec_command(remotecmd)
+            channel = transport.open_session()
+            channel.set_combine_stderr(True)
+            channel.exec_command(remotecmd)
         except Exception, errmsg:
+            step.finish(error=errmsg)
+            transport.close()
             return S_ERROR("Can't run remote ssh to %s: %s" % ( publicIP, errmsg ))
 
+        # the script runs asynchronously; the connection is closed (and
+        # the step finished) once it ends
+        closer = threading.Thread(target=DiracSshContext._close_after_exit,
+                                  args=(channel, transport, step))
+        closer.daemon = True
+        closer.start()
+
         return S_OK()
+
+    @staticmethod
+    def _run(transport, command):
+        """
+        Runs the command on a new session of the transport and returns
+        its exit status and its output (stdout and stderr).
+        """
+        channel = transport.open_session()
+        try:
+            channel.set_combine_stderr(True)
+            channel.exec_command(command)
+            output = channel.makefile('rb').read()
+            return channel.recv_exit_status(), output
+        finally:
+            channel.close()
+
+    @staticmethod
+    def _close_after_exit(channel, transport, step=NULL_SPAN):
+        # the output of the script is not used but must be read: the
+        # script blocks once the window of the channel is full
+        try:
+            while channel.recv(32768):
+                pass
+            status = channel.recv_exit_status()
+        except Exception, errmsg:
+            step.finish(error=errmsg)
+        else:
+            step.set_attribute('exitStatus', status)
+            if status != 0:
+                step.finish(error='exit status %s' % status)
+            else:
+                step.finish()
+        finally:
+            transport.close()
@@ -19,8 +19,10 @@ Detailed implementation of the StratusLab methods for the StratusLabClient
 class.  Uses the Libcloud API to connect to the StratusLab services.
 """
 
+import hashlib
 import os
-import tempfile
+import threading
+import time
 from ConfigParser import SafeConfigParser
 from StringIO import StringIO
 from contextlib import closing
@@ -36,6 +38,7 @@ set_driver('STRATUSLAB',
 
 from libcloud.compute.base import NodeAuthSSHKey
 from libcloud.compute.providers import get_driver
+from libcloud.compute.types import NodeState
 
 try:
     from DIRAC import gLogger, S_OK, S_ERROR
@@ -43,11 +46,39 @@ except:
     from stratuslab.dirac.DiracMock import gLogger, S_OK, S_ERROR
 
 from stratuslab.dirac.DiracSshContext import DiracSshContext
+from stratuslab.dirac.contextualization import ContextualizationPool, ContextFuture
+from stratuslab.dirac.ssh_probe import SshProber
+from stratuslab.dirac.tracing import Tracer, TraceStore, JsonLinesExporter
 
 
 class StratusLabClient(object):
     """ Implementation of the StratusLabImage functionality. """
 
+    # Drivers shared by all of the clients of the process, keyed by
+    # the hash of the StratusLab ('ex_') endpoint parameters.
+    _drivers = {}
+    _drivers_lock = threading.Lock()
+
+    # Worker pool shared by all of the clients for asynchronous
+    # contextualization.
+    _context_pool = None
+
+    # Single prober (one select loop) for the SSH services of all of the
+    # instances being contextualized.
+    _ssh_prober = None
+
+    # Root spans of the instances created by the clients of the
+    # process, keyed by DIRAC instance identifier.
+    _trace_store = TraceStore()
+
+    # Open 'ready' spans (from the creation of an instance to the end
+    # of its contextualization), keyed by DIRAC instance identifier.
+    _ready_store = TraceStore()
+
+    # Maximum time (in seconds) that a batch of instances is waited for
+    # before their contextualization.
+    WAIT_TIMEOUT = 600
+
     def __init__(self, endpointConfiguration, imageConfiguration):
         """
         Initializes this class with the applianceIdentifier (Stratuslab Marketplace
@@ -71,19 +102,22 @@ class StratusLabClient(object):
 
         self.log = gLogger.getSubLogger(self.__class__.__name__)
 
-        # Create the configuration file for the StratusLab driver.
         self.endpoint_config = endpointConfiguration.config()
-        path = StratusLabClient._create_stratuslab_config(self.endpoint_config)
-        try:
-            # Obtain instance of StratusLab driver.
-            StratusLabDriver = get_driver('STRATUSLAB')
-            self._driver = StratusLabDriver('unused-key', stratuslab_user_config=path)
 
-        finally:
-            try:
-                os.remove(path)
-            except:
-                pass
+        trace_file = self.endpoint_config.get('traceFile')
+        if trace_file:
+            self.tracer = Tracer(JsonLinesExporter(trace_file))
+        else:
+            self.tracer = Tracer()
+
+        # Obtain the (shared) instance of the StratusLab driver.
+        self._driver = StratusLabClient._get_driver(self.endpoint_config)
+
+        # Contextualizations of instances of the same endpoint share
+        # the limit on the number of simultaneous SSH sessions.
+        self._endpoint_key = StratusLabClient._driver_key(self.endpoint_config)
+        self.max_context_sessions = int(self.endpoint_config.get('maxContextSessions',
+                                                                 ContextualizationPool.DEFAULT_MAX_SESSIONS))
 
         self.image_config = imageConfiguration.config()
 
@@ -128,6 +162,18 @@ class StratusLabClient(object):
         with open(ssh_public_key_path) as f:
             pubkey = NodeAuthSSHKey(f.read())
 
+        # The root span covers the creation of the instance; the spans
+        # of the later phases, possibly recorded by other clients, are
+        # linked to it by the trace identifier, the DIRAC instance
+        # identifier.  The 'ready' span, from the end of the creation to
+        # the end of the contextualization, measures the time until the
+        # instance can take jobs.
+        trace = self.tracer.start_span('instance', vmdiracInstanceID,
+                                       siteName=self.endpoint_config.get('siteName'),
+                                       image=getattr(self.image, 'id', None),
+                                       size=getattr(self.size, 'id', None))
+        span = trace.child('create')
+
         # Create the new instance, called a 'node' for Libcloud.
         try:
             node = self._driver.create_node(name=vmdiracInstanceID,
@@ -141,8 +187,18 @@ class StratusLabClient(object):
             else:
                 public_ip = None
 
+            span.set_attribute('node', node.id)
+            span.finish()
+            trace.set_attribute('node', node.id)
+            trace.finish()
+            if vmdiracInstanceID:
+                StratusLabClient._trace_store.put(trace)
+                StratusLabClient._ready_store.put(trace.child('ready', node=node.id))
+
             return S_OK((node, public_ip))
         except Exception, e:
+            span.finish(error=e)
+            trace.finish(error=e)
             return S_ERROR(e)
 
     def status(self, node):
@@ -184,11 +240,21 @@ class StratusLabClient(object):
         :return: S_OK | S_ERROR
         """
 
+        if not node:
+            return S_OK()
+
+        ready = StratusLabClient._ready_store.pop(node.name)
+        if ready is not None:
+            ready.finish(error='terminated before contextualization')
+
+        trace = StratusLabClient._trace_store.pop(node.name)
+        span = self._span(node, 'terminate', trace)
         try:
-            if node:
-                node.destroy()
+            node.destroy()
+            span.finish()
             return S_OK()
         except Exception, e:
+            span.finish(error=e)
             return S_ERROR(e)
 
     def contextualize(self, node, public_ip):
@@ -206,25 +272,245 @@ class StratusLabClient(object):
         :return: S_OK(node) | S_ERROR
         """
 
-        self._driver.wait_until_running([node])
+        span = self._span(node, 'contextualize', contextMethod=self.context_method)
+
+        try:
+            with span.child('wait_until_running'):
+                self._driver.wait_until_running([node])
+        except Exception, e:
+            self._finish_contextualize(node, span, error=e)
+            raise
+
+        # A running instance does not necessarily accept SSH connections
+        # yet; wait for its SSH service before opening a session.
+        if self.context_method == 'ssh':
+            public_ip = self._public_ip(node, public_ip)
+
+            with span.child('wait_for_ssh', publicIP=public_ip):
+                ready = public_ip and self._get_ssh_prober().wait(public_ip)
+            if not ready:
+                self._finish_contextualize(node, span, error='ssh service not available')
+                return S_ERROR('ssh service of %s (%s) not available' % (node, public_ip))
+
+        return self._run_context_function(node, public_ip, span)
+
+    def contextualize_async(self, node, public_ip, callback=None):
+        """
+        Schedules the contextualization of the given instance in the
+        shared worker pool and returns immediately.  The returned
+        ContextFuture gives the result of contextualize(); the
+        optional callback is called with the future once it is done.
+
+        :return: ContextFuture
+        """
+        future = self._get_context_pool().submit(self._contextualize_job, node, public_ip)
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+    def contextualize_batch(self, instances, callback=None):
+        """
+        Schedules the contextualization of all of the given instances,
+        a list of (node, public_ip) tuples, and returns the list of
+        ContextFutures in the same order immediately.
+
+        A single background thread polls the instances that are not
+        yet running, with one Monitor request per tick for the whole
+        batch.  Each instance is handed on as soon as it is running:
+        for the 'ssh' method, its address is watched by the shared SSH
+        prober and its context function is submitted to the worker
+        pool once the SSH service answers.  At most
+        max_context_sessions SSH sessions are open at the same time
+        towards the endpoint.
+
+        :return: [ ContextFuture ]
+        """
+        futures = []
+        jobs = []
+        for node, public_ip in instances:
+            future = ContextFuture()
+            if callback is not None:
+                future.add_done_callback(callback)
+            futures.append(future)
+
+            span = self._span(node, 'contextualize', contextMethod=self.context_method)
+            jobs.append((node, public_ip, span, future))
+
+        poller = threading.Thread(target=self._poll_batch, args=(jobs,),
+                                  name='contextualization-batch')
+        poller.daemon = True
+        poller.start()
+
+        return futures
+
+    def _poll_batch(self, jobs, timeout=WAIT_TIMEOUT, wait_period=3):
+        """
+        Polls the nodes of the jobs until each of them is running (see
+        _on_running), terminated or the timeout has expired.
+        """
+        waiting = {}
+        for job in jobs:
+            node, _, span, _ = job
+            waiting[node.id] = (job, span.child('wait_until_running'))
+
+        end = time.time() + timeout
+        while waiting:
+            try:
+                details = self._driver.ex_get_nodes_details(
+                    [job[0] for job, _ in waiting.values()])
+            except Exception, e:
+                # retried on the next tick
+                self.log.error('cannot get the details of the instances: %s' % e)
+                details = {}
+
+            states = []
+            for node_id, (job, wait) in waiting.items():
+                node_details = details.get(node_id)
+                if node_details is None:
+                    states.append(None)
+                elif node_details['state'] == NodeState.TERMINATED:
+                    del waiting[node_id]
+                    wait.finish(error='terminated')
+                    self._fail_job(job, 'node %s has been terminated' % node_id)
+                elif node_details['state'] == NodeState.RUNNING and job[0].public_ips:
+                    del waiting[node_id]
+                    wait.finish()
+                    self._on_running(job)
+                else:
+                    states.append(node_details['state_summary'])
+
+            if not waiting:
+                return
+
+            remaining = end - time.time()
+            if remaining <= 0:
+                for job, wait in waiting.values():
+                    wait.finish(error='timeout')
+                    self._fail_job(job, 'not running after %s seconds' % timeout)
+                return
+
+            interval = min([self._driver.WAIT_INTERVALS.get((state or '').lower(), wait_period)
+                            for state in states])
+            time.sleep(min(interval, remaining))
+
+    def _on_running(self, job):
+        """
+        Hands on a running instance: its context function is submitted
+        to the worker pool, once its SSH service answers for the 'ssh'
+        method.
+        """
+        node, public_ip, span, future = job
+        public_ip = self._public_ip(node, public_ip)
+        job = (node, public_ip, span, future)
+
+        if self.context_method != 'ssh':
+            self._get_context_pool().submit(self._complete_job, job)
+            return
+
+        wait = span.child('wait_for_ssh', publicIP=public_ip)
+
+        def ssh_done(_, ready):
+            if ready:
+                wait.finish()
+                self._get_context_pool().submit(self._complete_job, job)
+            else:
+                wait.finish(error='ssh service not available')
+                self._fail_job(job, 'ssh service of %s (%s) not available' % (node, public_ip))
+
+        self._get_ssh_prober().watch(public_ip, ssh_done)
+
+    def _complete_job(self, job):
+        node, public_ip, span, future = job
+        try:
+            result = self._run_context_function(node, public_ip, span)
+        except Exception, e:
+            result = S_ERROR('error contextualizing %s: %s' % (node, e))
+        future.set_result(result)
+
+    def _fail_job(self, job, error):
+        node, _, span, future = job
+        self._finish_contextualize(node, span, error=error)
+        future.set_result(S_ERROR('error contextualizing %s: %s' % (node, error)))
+
+    @staticmethod
+    def _public_ip(node, public_ip):
+        if not public_ip and node.public_ips:
+            return node.public_ips[0]
+        return public_ip
 
+    def _run_context_function(self, node, public_ip, span):
+        """
+        Runs the context function of the running instance, within the
+        limit of SSH sessions of the endpoint, and finishes the span.
+        """
         context_choices = {'ssh': self._ssh_contextualization,
                            'none': self._noop_contextualization}
 
         try:
             context_function = context_choices[self.context_method]
         except KeyError, e:
+            self._finish_contextualize(node, span, error='invalid context method')
             return S_ERROR('invalid context method: %s' % self.context_method)
 
         try:
-            result = context_function(node, public_ip)
+            with self._get_context_pool().session(self._endpoint_key,
+                                                  self.max_context_sessions):
+                result = context_function(node, public_ip, span)
             if not result['OK']:
+                self._finish_contextualize(node, span, error=result['Message'])
                 return result
         except Exception, e:
+            self._finish_contextualize(node, span, error=e)
             return S_ERROR('error running context function: %s' % e)
 
+        self._finish_contextualize(node, span)
         return S_OK(node)
 
+    @staticmethod
+    def _finish_contextualize(node, span, error=None):
+        """
+        Finishes the contextualization span and, with the same error,
+        the 'ready' span of the node started by create().
+        """
+        span.finish(error=error)
+        ready = StratusLabClient._ready_store.pop(node.name)
+        if ready is not None:
+            ready.finish(error=error)
+
+    def _contextualize_job(self, node, public_ip):
+        try:
+            return self.contextualize(node, public_ip)
+        except Exception, e:
+            return S_ERROR('error contextualizing %s: %s' % (node, e))
+
+    @classmethod
+    def _get_context_pool(cls):
+        with cls._drivers_lock:
+            if cls._context_pool is None:
+                cls._context_pool = ContextualizationPool()
+            return cls._context_pool
+
+    @classmethod
+    def _get_ssh_prober(cls):
+        with cls._drivers_lock:
+            if cls._ssh_prober is None:
+                cls._ssh_prober = SshProber()
+            return cls._ssh_prober
+
+    def _span(self, node, name, trace=None, **attributes):
+        """
+        Starts a span for the given phase of the node's lifecycle.  The
+        trace identifier is the node name (the DIRAC instance
+        identifier); the span is a child of the root span recorded by
+        create() if that is known to the process.
+        """
+        if trace is None:
+            trace = StratusLabClient._trace_store.get(node.name)
+        if trace is not None:
+            return self.tracer.start_span(name, trace.trace_id,
+                                          parent_id=trace.span_id, **attributes)
+        return self.tracer.start_span(name, node.name, **attributes)
+
     def _get_location(self):
         locations = self._driver.list_locations()
         if len(locations) > 0:
@@ -232,11 +518,7 @@ class StratusLabClient(object):
         raise Exception('location cannot be found')
 
     def _get_image(self, applianceIdentifier):
-        images = self._driver.list_images()
-        for image in images:
-            if image.id == applianceIdentifier:
-                return image
-        raise Exception('image for %s cannot be found' % applianceIdentifier)
+        return self._driver.get_image(applianceIdentifier)
 
     def _get_size(self, sizeIdentifier):
         sizes = self._driver.list_sizes()
@@ -245,15 +527,50 @@ class StratusLabClient(object):
                 return size
         raise Exception('size for %s cannot be found' % sizeIdentifier)
 
+    @classmethod
+    def _get_driver(cls, endpoint_params):
+        """
+        Returns the StratusLab driver for the given endpoint configuration.
+        A single driver (with its caches of locations, sizes and images) is
+        created per process for each distinct StratusLab configuration and
+        shared by all of the clients for that endpoint.
+        """
+        key = StratusLabClient._driver_key(endpoint_params)
+
+        with cls._drivers_lock:
+            try:
+                return cls._drivers[key]
+            except KeyError:
+                cfg = StratusLabClient._create_stratuslab_config(endpoint_params)
+                StratusLabDriver = get_driver('STRATUSLAB')
+                driver = StratusLabDriver('unused-key',
+                                          stratuslab_user_config=StringIO(cfg))
+                cls._drivers[key] = driver
+                return driver
+
+    @classmethod
+    def clear_drivers(cls):
+        """
+        Discards the shared drivers, so that the next client for each
+        endpoint creates a new one.
+        """
+        with cls._drivers_lock:
+            cls._drivers = {}
+
+    @staticmethod
+    def _driver_key(endpoint_params):
+        items = [(key, value) for key, value in endpoint_params.items()
+                 if key.startswith('ex_')]
+        return hashlib.sha1(repr(sorted(items))).hexdigest()
+
     @staticmethod
     def _create_stratuslab_config(endpoint_params):
         """
         The argument, endpoint_params, is a dictionary with the configuration for
-        the StratusLab Libcloud API.  These parameters are written to a
-        temporary file within a [default] section.
+        the StratusLab Libcloud API.  These parameters are written within a
+        [default] section of an in-memory configuration file.
 
-        This function returns the name of the temporary file created.  The
-        caller of this function is responsible for deleting this file.
+        This function returns the contents of the configuration file.
         """
         parser = SafeConfigParser()
         for key, value in endpoint_params.items():
@@ -267,13 +584,9 @@ class StratusLabClient(object):
             parser.write(mem_buffer)
             cfg = mem_buffer.getvalue().replace('[DEFAULT]', '[default]', 1)
 
-        _, path = tempfile.mkstemp(text=True)
-        with open(path, 'w') as f:
-            f.write(cfg)
-
-        return path
+        return cfg
 
-    def _ssh_contextualization(self, node, public_ip):
+    def _ssh_contextualization(self, node, public_ip, span=None):
 
         cvmfs_http_proxy = self.endpoint_config.get('CVMFS_HTTP_PROXY')
         siteName = self.endpoint_config.get('siteName')
@@ -307,10 +620,11 @@ class StratusLabClient(object):
                                                   vmCvmfsContextURL=vmCvmfsContextURL,
                                                   vmDiracContextURL=vmDiracContextURL,
                                                   siteName=siteName,
-                                                  cpuTime=cpuTime)
+                                                  cpuTime=cpuTime,
+                                                  span=span)
 
         return result
 
-    def _noop_contextualization(self, node, public_ip):
+    def _noop_contextualization(self, node, public_ip, span=None):
         return S_OK()
 
@@ -33,6 +33,8 @@ class StratusLabEndpointConfiguration(EndpointConfiguration):
     DIRAC_REQUIRED_KEYS = frozenset(['vmPolicy', 'vmStopPolicy', 'cloudDriver',
                                      'siteName', 'maxEndpointInstances'])
 
+    DIRAC_OPTIONAL_KEYS = frozenset(['traceFile', 'maxContextSessions'])
+
     STRATUSLAB_REQUIRED_KEYS = frozenset(['ex_endpoint'])
 
     STRATUSLAB_OPTIONAL_KEYS = frozenset(['ex_name', 'ex_country',
@@ -78,7 +80,8 @@ class StratusLabEndpointConfiguration(EndpointConfiguration):
         defined_keys = frozenset(cfg.keys())
 
         all_required_keys = self.DIRAC_REQUIRED_KEYS.union(self.STRATUSLAB_REQUIRED_KEYS)
-        all_keys = all_required_keys.union(self.STRATUSLAB_OPTIONAL_KEYS)
+        all_keys = all_required_keys.union(self.DIRAC_OPTIONAL_KEYS)
+        all_keys = all_keys.union(self.STRATUSLAB_OPTIONAL_KEYS)
 
         missing_keys = all_required_keys.difference(defined_keys)
         if missing_keys:
@@ -160,6 +160,29 @@ class StratusLabImage:
         result = self._impl.contextualize(instanceId, public_ip)
         return self._logResult(result, 'contextualizeInstance: %s, %s' % (instanceId, public_ip))
 
+    def contextualizeInstances(self, instances):
+        """
+        Contextualizes several instances in parallel.  This is equivalent to
+        calling contextualizeInstance for each of the instances, but the
+        total time is close to that of the slowest instance.
+
+        :Parameters:
+          **instances** - `list`
+            list of (instanceId, public_ip) tuples
+
+        :return: S_OK([ S_OK(instanceId) | S_ERROR ]) with one result per instance
+        """
+
+        futures = self._impl.contextualize_batch(instances)
+
+        results = []
+        for (instanceId, public_ip), future in zip(instances, futures):
+            result = future.result()
+            self._logResult(result, 'contextualizeInstance: %s, %s' % (instanceId, public_ip))
+            results.append(result)
+
+        return S_OK(results)
+
     def _logResult(self, result, msg):
         """
         Checks if the return value is an error.  If so it logs it as an error along with the
@@ -0,0 +1,163 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Packing of the files copied to the virtual machine instances for the
+contextualization (certificate, key, script) into a single compressed
+archive.  The archive is built once and reused for all of the
+instances; files that the instance already has (same SHA-256 checksum)
+are left out of the transfer.
+"""
+
+import hashlib
+import os
+import pipes
+import tarfile
+import threading
+
+from StringIO import StringIO
+
+
+class ContextBundle(object):
+    """
+    Set of (local path, remote path) files.  Remote paths must be
+    absolute; the archives extract to the same paths with
+    'tar -xzf <archive> -C /'.
+    """
+
+    def __init__(self, files):
+        self.files = tuple(files)
+
+        self._lock = threading.Lock()
+        self._checksums = {}
+        for local_path, remote_path in self.files:
+            if not remote_path.startswith('/'):
+                raise ValueError('remote path must be absolute: %s' % remote_path)
+            self._checksums[remote_path] = ContextBundle._sha256(local_path)
+        self._archives = {}
+
+    @staticmethod
+    def _sha256(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(65536), ''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def remote_paths(self):
+        return [remote_path for _, remote_path in self.files]
+
+    def checksum_command(self):
+        """
+        Returns the shell command printing the SHA-256 checksums of the
+        remote files that exist on the instance (sha256sum format).
+        """
+        paths = ' '.join([pipes.quote(path) for path in self.remote_paths()])
+        return 'sha256sum %s 2>/dev/null' % paths
+
+    @staticmethod
+    def parse_checksums(output):
+        """
+        Parses the output of sha256sum into a dictionary mapping the
+        paths to their checksums.
+        """
+        checksums = {}
+        for line in output.splitlines():
+            parts = line.strip().split(None, 1)
+            if len(parts) == 2:
+                checksum, path = parts
+                # binary mode is flagged with a '*' before the path
+                checksums[path.lstrip('*')] = checksum.lower()
+        return checksums
+
+    def needed(self, remote_checksums=None):
+        """
+        Returns the list of (local path, remote path) files whose
+        checksum on the instance differs from the local one.
+        """
+        remote_checksums = remote_checksums or {}
+        return [(local_path, remote_path) for local_path, remote_path in self.files
+                if remote_checksums.get(remote_path) != self._checksums[remote_path]]
+
+    def archive(self, files=None):
+        """
+        Returns the contents of the gzipped tar archive with the given
+        files (all files by default).  Archives are built once for
+        each distinct set of files and then reused.
+        """
+        if files is None:
+            files = self.files
+        key = frozenset([remote_path for _, remote_path in files])
+
+        with self._lock:
+            try:
+                return self._archives[key]
+            except KeyError:
+                data = ContextBundle._build_archive(files)
+                self._archives[key] = data
+                return data
+
+    @staticmethod
+    def _build_archive(files):
+        buf = StringIO()
+        tar = tarfile.open(fileobj=buf, mode='w:gz')
+        try:
+            for local_path, remote_path in files:
+                info = tar.gettarinfo(local_path, arcname=remote_path.lstrip('/'))
+                info.uid = info.gid = 0
+                info.uname = info.gname = 'root'
+                with open(local_path, 'rb') as f:
+                    tar.addfile(info, f)
+        finally:
+            tar.close()
+        return buf.getvalue()
+
+    @staticmethod
+    def extract_command(archive_path):
+        """
+        Returns the shell command extracting the uploaded archive to
+        the remote paths and removing it.
+        """
+        archive_path = pipes.quote(archive_path)
+        return 'tar -xzf %s -C / && rm -f %s' % (archive_path, archive_path)
+
+
+_bundles = {}
+_bundles_lock = threading.Lock()
+
+
+def get_bundle(files):
+    """
+    Returns the ContextBundle for the given (local path, remote path)
+    files, shared by all of the contextualizations of the process.
+    A new bundle is built when one of the local files changes.
+    """
+    key = []
+    for local_path, remote_path in files:
+        stat = os.stat(local_path)
+        key.append((local_path, remote_path, stat.st_size, stat.st_mtime))
+    key = tuple(key)
+
+    with _bundles_lock:
+        bundle = _bundles.get(key)
+        if bundle is None:
+            bundle = ContextBundle(files)
+            # only the current version of a set of files is kept
+            for old_key in _bundles.keys():
+                if [k[:2] for k in old_key] == [k[:2] for k in key]:
+                    del _bundles[old_key]
+            _bundles[key] = bundle
+        return bundle
@@ -0,0 +1,186 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Worker pool used to contextualize many virtual machine instances in
+parallel, with a limit on the number of simultaneous SSH sessions for
+each cloud endpoint.
+"""
+
+import Queue
+import sys
+import threading
+
+from contextlib import contextmanager
+
+try:
+    from DIRAC import gLogger
+except:
+    from stratuslab.dirac.DiracMock import gLogger
+
+_log = gLogger.getSubLogger('ContextualizationPool')
+
+
+class ContextFuture(object):
+    """
+    Result of a job submitted to a ContextualizationPool.  Callbacks
+    added with add_done_callback are called with the future once the
+    job has completed (immediately if it already has).
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._event.isSet()
+
+    def result(self, timeout=None):
+        """
+        Waits for the job to complete and returns its value, or raises
+        the exception raised by the job.  Raises an exception if the
+        job has not completed within the timeout (in seconds).
+        """
+        self._event.wait(timeout)
+        if not self._event.isSet():
+            raise Exception('contextualization job not completed after %s s' % timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._event.isSet():
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def set_result(self, result):
+        """
+        Completes the future with the given result.  Only needed for
+        futures that are not created by ContextualizationPool.submit.
+        """
+        self._set(result=result)
+
+    def _set(self, result=None, exc_info=None):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception, e:
+            # a failing callback must not stop the worker
+            _log.error('contextualization callback failed: %s' % e)
+
+
+class ContextualizationPool(object):
+    """
+    Pool of worker threads running contextualization jobs.  Jobs
+    spend most of their time waiting for the instances to boot, so
+    the number of workers may be large; the number of SSH sessions
+    opened at the same time towards an endpoint is limited separately
+    with the session() context manager.
+
+    Worker threads are started as jobs are submitted, up to
+    max_workers, and run as daemons.
+    """
+
+    DEFAULT_MAX_WORKERS = 32
+
+    DEFAULT_MAX_SESSIONS = 8
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self.max_workers = max_workers
+
+        self._lock = threading.Lock()
+        self._jobs = Queue.Queue()
+        self._workers = []
+        self._idle = 0
+        self._sessions = {}
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Schedules the call of the function with the given arguments
+        and returns a ContextFuture for its result.
+        """
+        future = ContextFuture()
+
+        with self._lock:
+            if self._idle > 0:
+                self._idle -= 1
+            elif len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._run,
+                                          name='contextualization-%d' % len(self._workers))
+                worker.daemon = True
+                self._workers.append(worker)
+                worker.start()
+
+        self._jobs.put((future, function, args, kwargs))
+        return future
+
+    def map(self, function, jobs, callback=None):
+        """
+        Submits one call of the function for each tuple of arguments
+        in jobs and returns the list of futures in the same order.
+        The optional callback is added to each of the futures.
+        """
+        futures = []
+        for args in jobs:
+            future = self.submit(function, *args)
+            if callback is not None:
+                future.add_done_callback(callback)
+            futures.append(future)
+        return futures
+
+    @contextmanager
+    def session(self, key, limit=DEFAULT_MAX_SESSIONS):
+        """
+        Context manager that allows at most 'limit' blocks to run at
+        the same time for the given key (for example, an endpoint).
+        The limit given with the first use of a key applies.
+        """
+        with self._lock:
+            semaphore = self._sessions.get(key)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(limit)
+                self._sessions[key] = semaphore
+
+        semaphore.acquire()
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    def _run(self):
+        while True:
+            future, function, args, kwargs = self._jobs.get()
+            try:
+                future._set(result=function(*args, **kwargs))
+            except Exception:
+                future._set(exc_info=sys.exc_info())
+
+            with self._lock:
+                self._idle += 1
@@ -0,0 +1,274 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Detection of the availability of the SSH service of many virtual
+machine instances at once.  A single background thread probes all of
+the watched addresses with non-blocking sockets in one select() loop:
+an address is ready once a TCP connection succeeds and the server
+sends its SSH identification line ('SSH-...').
+"""
+
+import errno
+import select
+import socket
+import threading
+import time
+
+try:
+    from DIRAC import gLogger
+except:
+    from stratuslab.dirac.DiracMock import gLogger
+
+_log = gLogger.getSubLogger('SshProber')
+
+
+class _Probe(object):
+
+    __slots__ = ('address', 'callback', 'deadline', 'sock', 'connected',
+                 'buffer', 'attempt_deadline', 'next_attempt')
+
+    def __init__(self, address, callback, deadline):
+        self.address = address
+        self.callback = callback
+        self.deadline = deadline
+        self.sock = None
+        self.connected = False
+        self.buffer = ''
+        self.attempt_deadline = None
+        self.next_attempt = 0
+
+
+class SshProber(object):
+    """
+    Watches addresses until their SSH service answers or a timeout
+    expires.  Addresses are host names or IP addresses (probed on the
+    default port) or (host, port) tuples.  Failed connection attempts
+    are retried every retry_interval seconds; an attempt that gets no
+    banner within connect_timeout seconds is abandoned and retried.
+
+    The probing thread is started when an address is watched and
+    stops when there is nothing left to watch.
+    """
+
+    DEFAULT_PORT = 22
+
+    DEFAULT_TIMEOUT = 300
+
+    DEFAULT_RETRY_INTERVAL = 2
+
+    DEFAULT_CONNECT_TIMEOUT = 5
+
+    # maximum size of the data accepted before the identification line
+    MAX_BANNER_SIZE = 8192
+
+    # maximum time (in seconds) before new watches are picked up
+    POLL_INTERVAL = 0.2
+
+    def __init__(self, port=DEFAULT_PORT, retry_interval=DEFAULT_RETRY_INTERVAL,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+        self.port = port
+        self.retry_interval = retry_interval
+        self.connect_timeout = connect_timeout
+
+        self._lock = threading.Lock()
+        self._pending = []
+        self._thread = None
+
+    def watch(self, address, callback, timeout=DEFAULT_TIMEOUT):
+        """
+        Starts watching the address.  The callback is called from the
+        probing thread with the address and True as soon as the SSH
+        service answers, or with False once the timeout (in seconds)
+        has expired.
+        """
+        probe = _Probe(address, callback, time.time() + timeout)
+        with self._lock:
+            self._pending.append(probe)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='ssh-prober')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def wait(self, address, timeout=DEFAULT_TIMEOUT):
+        """
+        Blocks until the SSH service of the address answers (returns
+        True) or the timeout expires (returns False).
+        """
+        event = threading.Event()
+        result = []
+
+        def done(_, ready):
+            result.append(ready)
+            event.set()
+
+        self.watch(address, done, timeout)
+        event.wait(timeout + 2 * self.POLL_INTERVAL)
+        return bool(result and result[0])
+
+    def wait_all(self, addresses, timeout=DEFAULT_TIMEOUT):
+        """
+        Watches all of the addresses at once and blocks until each of
+        them has answered or the timeout has expired.  Returns the list
+        of addresses that answered, in the order in which they did.
+        """
+        lock = threading.Lock()
+        remaining = [len(addresses)]
+        ready = []
+        event = threading.Event()
+
+        def done(address, is_ready):
+            with lock:
+                if is_ready:
+                    ready.append(address)
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    event.set()
+
+        if not addresses:
+            return ready
+
+        for address in addresses:
+            self.watch(address, done, timeout)
+        event.wait(timeout + 2 * self.POLL_INTERVAL)
+
+        with lock:
+            return list(ready)
+
+    def _run(self):
+        probes = []
+        while True:
+            with self._lock:
+                probes.extend(self._pending)
+                self._pending = []
+                if not probes:
+                    self._thread = None
+                    return
+
+            now = time.time()
+            for probe in list(probes):
+                if now >= probe.deadline:
+                    self._finish(probes, probe, False)
+                elif probe.sock is None:
+                    if now >= probe.next_attempt:
+                        self._connect(probe, now)
+                elif now >= probe.attempt_deadline:
+                    self._retry(probe, now)
+
+            readers = [p.sock for p in probes if p.sock is not None and p.connected]
+            writers = [p.sock for p in probes if p.sock is not None and not p.connected]
+
+            if not readers and not writers:
+                time.sleep(self.POLL_INTERVAL)
+                continue
+
+            try:
+                readable, writable, _ = select.select(readers, writers, [],
+                                                      self.POLL_INTERVAL)
+            except (select.error, socket.error):
+                continue
+
+            now = time.time()
+            by_socket = dict([(p.sock, p) for p in probes if p.sock is not None])
+            for sock in writable:
+                self._on_connected(by_socket[sock], now)
+            for sock in readable:
+                probe = by_socket[sock]
+                if self._on_data(probe, now):
+                    self._finish(probes, probe, True)
+
+    def _target(self, address):
+        if isinstance(address, tuple):
+            return address
+        return address, self.port
+
+    def _connect(self, probe, now):
+        probe.attempt_deadline = now + self.connect_timeout
+        try:
+            host, port = self._target(probe.address)
+            family, socktype, proto, _, sockaddr = \
+                socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+            sock = socket.socket(family, socktype, proto)
+        except socket.error:
+            self._retry(probe, now)
+            return
+
+        sock.setblocking(0)
+        probe.sock = sock
+        err = sock.connect_ex(sockaddr)
+        if err == 0:
+            probe.connected = True
+        elif err not in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            self._retry(probe, now)
+
+    def _on_connected(self, probe, now):
+        err = probe.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err == 0:
+            probe.connected = True
+        else:
+            self._retry(probe, now)
+
+    def _on_data(self, probe, now):
+        """
+        Reads the data available from the server and returns True if
+        the SSH identification line has been received.
+        """
+        try:
+            data = probe.sock.recv(1024)
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._retry(probe, now)
+            return False
+
+        if not data:
+            self._retry(probe, now)
+            return False
+
+        # the server may send other lines before the identification line
+        probe.buffer += data
+        lines = probe.buffer.split('\n')
+        for line in lines[:-1]:
+            if line.startswith('SSH-'):
+                return True
+        probe.buffer = lines[-1]
+
+        if len(probe.buffer) > self.MAX_BANNER_SIZE:
+            self._retry(probe, now)
+        return False
+
+    def _retry(self, probe, now):
+        self._close(probe)
+        probe.next_attempt = now + self.retry_interval
+
+    @staticmethod
+    def _close(probe):
+        if probe.sock is not None:
+            try:
+                probe.sock.close()
+            except socket.error:
+                pass
+        probe.sock = None
+        probe.connected = False
+        probe.buffer = ''
+
+    def _finish(self, probes, probe, ready):
+        self._close(probe)
+        probes.remove(probe)
+        try:
+            probe.callback(probe.address, ready)
+        except Exception, e:
+            # a failing callback must not stop the prober
+            _log.error('ssh probe callback for %s failed: %s' % (probe.address, e))
@@ -0,0 +1,214 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Minimal tracing of the phases of the lifecycle of a virtual machine
+instance (creation, boot, contextualization, termination).  All of the
+spans of an instance share the same trace identifier, the DIRAC
+instance identifier, so the phases recorded by different clients or
+processes can be joined.  Finished spans are passed to an exporter,
+for example JsonLinesExporter which appends them to a local file.
+"""
+
+import json
+import threading
+import time
+import uuid
+
+try:
+    from DIRAC import gLogger
+except:
+    from stratuslab.dirac.DiracMock import gLogger
+
+_log = gLogger.getSubLogger('Tracer')
+
+
+class Span(object):
+    """
+    Timed phase of the lifecycle of an instance.  A span is finished
+    either explicitly with finish() or at the end of a 'with' block,
+    in which case an exception raised within the block is recorded
+    as the error of the span (and is not suppressed).
+    """
+
+    def __init__(self, tracer, name, trace_id, parent_id=None, attributes=None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self.end = None
+        self.error = None
+
+    def child(self, name, **attributes):
+        """
+        Starts a new span that is a child of this one.
+        """
+        return Span(self.tracer, name, self.trace_id,
+                    parent_id=self.span_id, attributes=attributes)
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def finish(self, error=None):
+        """
+        Ends the span, recording the error if one is given.  Only the
+        first call has an effect.
+        """
+        if self.end is not None:
+            return
+        self.end = time.time()
+        if error is not None:
+            self.error = str(error)
+        self.tracer.export(self)
+
+    @property
+    def duration(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def to_dict(self):
+        return {'trace_id': self.trace_id,
+                'span_id': self.span_id,
+                'parent_id': self.parent_id,
+                'name': self.name,
+                'start': self.start,
+                'end': self.end,
+                'duration': self.duration,
+                'status': 'ERROR' if self.error is not None else 'OK',
+                'error': self.error,
+                'attributes': self.attributes}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.finish(error=exc_value)
+        else:
+            self.finish()
+        return False
+
+
+class _NullSpan(object):
+    """
+    Span that records nothing; used when no span is given.
+    """
+
+    def child(self, name, **attributes):
+        return self
+
+    def set_attribute(self, key, value):
+        pass
+
+    def finish(self, error=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Tracer(object):
+    """
+    Creates root spans and passes the finished spans to the
+    exporter.  Without an exporter, finished spans are discarded.
+    """
+
+    def __init__(self, exporter=None):
+        self.exporter = exporter
+
+    def start_span(self, name, trace_id, parent_id=None, **attributes):
+        """
+        Starts a span for the given trace (instance) identifier.  The
+        span is a root span unless the identifier of its parent span
+        is given.
+        """
+        return Span(self, name, trace_id, parent_id=parent_id,
+                    attributes=attributes)
+
+    def export(self, span):
+        if self.exporter is not None:
+            try:
+                self.exporter.export(span)
+            except Exception, e:
+                # tracing must never break the lifecycle of the instance
+                _log.error('cannot export span %s: %s' % (span.name, e))
+
+
+class TraceStore(object):
+    """
+    Root spans of the instances, keyed by trace identifier, from which
+    the spans of the later phases take their trace and parent
+    identifiers.  At most max_traces root spans are kept; the oldest
+    ones are discarded first.
+    """
+
+    DEFAULT_MAX_TRACES = 10000
+
+    def __init__(self, max_traces=DEFAULT_MAX_TRACES):
+        self.max_traces = max_traces
+
+        self._lock = threading.Lock()
+        self._spans = {}
+
+    def put(self, span):
+        with self._lock:
+            self._spans[span.trace_id] = span
+            if len(self._spans) > self.max_traces:
+                # discard the oldest tenth at once rather than one
+                # root span for each new one
+                spans = sorted(self._spans.values(), key=lambda s: s.start)
+                for old in spans[:len(spans) - self.max_traces * 9 // 10]:
+                    del self._spans[old.trace_id]
+
+    def get(self, trace_id):
+        with self._lock:
+            return self._spans.get(trace_id)
+
+    def pop(self, trace_id):
+        with self._lock:
+            return self._spans.pop(trace_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._spans)
+
+
+class JsonLinesExporter(object):
+    """
+    Appends each finished span as a JSON object on its own line to
+    the given file.  The file is opened for each span, so several
+    processes can share it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), sort_keys=True, default=str)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
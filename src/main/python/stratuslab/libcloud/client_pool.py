@@ -0,0 +1,133 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Pool of long-lived StratusLab service clients (Monitor, PersistentDisk).
+"""
+
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+class ServiceClientPool(object):
+    """
+    Thread-safe pool of service clients.  Clients are grouped by an
+    arbitrary hashable key (e.g. the service class and the location
+    id).  A client is used by a single thread at a time: it is taken
+    from the pool for the duration of a 'with' block and returned to
+    the pool afterwards, so that its connection can be reused.
+
+    Clients that have been idle for more than idle_timeout seconds
+    are discarded, as are clients that fail the optional health
+    check or that raised an exception while in use.  At most
+    max_idle clients are kept for each key.
+    """
+
+    DEFAULT_IDLE_TIMEOUT = 300
+
+    DEFAULT_MAX_IDLE = 4
+
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 max_idle=DEFAULT_MAX_IDLE, health_check=None):
+        """
+        :param idle_timeout: seconds after which an idle client is
+        discarded
+        :param max_idle: maximum number of idle clients kept per key
+        :param health_check: optional function taking a client and
+        returning False if the client must not be reused
+        """
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self.health_check = health_check
+
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    @contextmanager
+    def client(self, key, factory):
+        """
+        Context manager providing a client for the given key.  An idle
+        client is reused if one is available; otherwise a new one is
+        created by calling factory().
+        """
+        client = self._checkout(key)
+        if client is None:
+            client = factory()
+
+        yield client
+
+        # Not reached if the block raised an exception: the state of
+        # the client (connection) is then unknown, so it is dropped.
+        self._checkin(key, client)
+
+    def evict_idle(self):
+        """
+        Discards all of the clients that have been idle for too long.
+        """
+        now = time.time()
+        with self._lock:
+            for key, idle in self._idle.items():
+                idle[:] = [(c, t) for c, t in idle if now - t <= self.idle_timeout]
+                if not idle:
+                    del self._idle[key]
+
+    def clear(self):
+        """
+        Discards all idle clients.
+        """
+        with self._lock:
+            self._idle = {}
+
+    def idle_count(self, key=None):
+        """
+        Returns the number of idle clients for the given key or for
+        all keys if no key is given.
+        """
+        with self._lock:
+            if key is not None:
+                return len(self._idle.get(key, []))
+            return sum([len(idle) for idle in self._idle.values()])
+
+    def _checkout(self, key):
+        now = time.time()
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    return None
+                client, last_used = idle.pop()
+
+            if now - last_used > self.idle_timeout:
+                continue
+
+            if self.health_check is not None:
+                try:
+                    healthy = self.health_check(client)
+                except Exception:
+                    healthy = False
+                if not healthy:
+                    continue
+
+            return client
+
+    def _checkin(self, key, client):
+        now = time.time()
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            idle[:] = [(c, t) for c, t in idle if now - t <= self.idle_timeout]
+            if len(idle) < self.max_idle:
+                idle.append((client, now))
@@ -28,7 +28,10 @@ Driver for StratusLab (http://stratuslab.eu) cloud infrastructures.
 #            'StratusLabNodeDriver')
 #
 
-import xml.etree.ElementTree as ET
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 
 from stratuslab.Monitor import Monitor
 from stratuslab.Runner import Runner
@@ -38,10 +41,27 @@ from stratuslab.PersistentDisk import PersistentDisk
 import stratuslab.Util as StratusLabUtil
 import ConfigParser as ConfigParser
 import urllib
+import urllib2
+import urlparse
 import uuid
 
+import logging
 import tempfile
+import time
 import os
+import Queue
+import socket
+import sys
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+from stratuslab.libcloud.client_pool import ServiceClientPool
+from stratuslab.libcloud.image_catalog import ImageCatalog
+from stratuslab.libcloud.marketplace_cache import MarketplaceCache
+from stratuslab.libcloud.node_watcher import NodeWatcher, diff_snapshots
+from stratuslab.libcloud.metrics import NullMetrics
+from stratuslab.libcloud.registry import NodeRegistry
 
 from libcloud.compute.base import NodeImage, NodeSize, Node
 from libcloud.compute.base import NodeAuthSSHKey, NodeDriver
@@ -49,6 +69,43 @@ from libcloud.compute.base import NodeLocation, UuidMixin
 from libcloud.compute.base import StorageVolume
 
 from libcloud.compute.types import NodeState
+from libcloud.common.types import LibcloudError
+
+_log = logging.getLogger(__name__)
+
+
+class _TimedStream(object):
+    """
+    Wrapper of a file-like object that ends the given timer (a
+    metrics context manager) when it is closed.  The timer records an
+    error if a read raised an exception.
+    """
+
+    def __init__(self, stream, timer):
+        self._stream = stream
+        self._timer = timer
+        self._exc_info = (None, None, None)
+        self._closed = False
+
+    def read(self, size=-1):
+        try:
+            return self._stream.read(size)
+        except:
+            self._exc_info = sys.exc_info()
+            raise
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._stream.close()
+        finally:
+            self._timer.__exit__(*self._exc_info)
+            self._exc_info = (None, None, None)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
 
 
 class StratusLabNodeSize(NodeSize):
@@ -74,13 +131,27 @@ class StratusLabNodeSize(NodeSize):
 class StratusLabNode(Node, UuidMixin):
     """
     Subclass of the standard Node class that uses a function to
-    lookup the state of the node.  Although a setter for the state
-    is defined, the value is ignored.
+    lookup the state of the node.
+
+    The attributes returned by a single Monitor request (vmDetail)
+    are kept as a snapshot of the node for state_ttl seconds.  The
+    state, host, public IP address and resources (template_cpu,
+    template_memory, template_disk_size) are all read from the same
+    snapshot, so reading several of them costs one request.  A state
+    set explicitly is cached for the same period.  A state_ttl of
+    None or 0 disables the cache so that every read of the state or
+    host queries the Monitor.
     """
 
     def __init__(self, node_id, name, state, public_ips, private_ips,
                  driver, size=None, image=None, extra=None):
 
+        # must be initialized before the superclass sets the state
+        self._cached_state = None
+        self._cached_state_time = None
+        self._snapshot = None
+        self._snapshot_time = None
+
         super(StratusLabNode, self).__init__(node_id, name, state,
                                              public_ips, private_ips,
                                              driver, size, image, extra)
@@ -90,49 +161,159 @@ class StratusLabNode(Node, UuidMixin):
         except (TypeError, KeyError):
             raise ValueError('extra[\'location\'] must be specified')
 
+        self.state_ttl = getattr(driver, 'state_ttl',
+                                 StratusLabNodeDriver.DEFAULT_STATE_TTL)
+
     @property
     def state(self):
-        return self.get_node_state()
+        if not self._is_fresh(self._cached_state_time):
+            self.refresh()
+        return self._cached_state
 
     @state.setter
     def state(self, value):
-        self.cached_state = value
+        self._cached_state = value
+        self._cached_state_time = time.time()
 
     @property
     def host(self):
+        return StratusLabNodeDriver._attrs_to_host(self.get_attributes())
+
+    def get_attributes(self):
+        """
+        Returns the attributes of the node from the snapshot, which
+        is refreshed first if it has expired.  The returned dictionary
+        must not be modified.
+        """
+        if not self._is_fresh(self._snapshot_time):
+            self.refresh()
+        return self._snapshot
+
+    def _is_fresh(self, timestamp):
+        if not self.state_ttl or timestamp is None:
+            return False
+        return (time.time() - timestamp) < self.state_ttl
+
+    def refresh(self):
+        """
+        Unconditionally recovers the attributes of the node from the
+        Monitor and updates the snapshot.  Returns the new state.
+        """
         vm_info = self.get_vm_info()
-        attrs = vm_info.getAttributes()
+        self.update_snapshot(vm_info.getAttributes())
+        return self._cached_state
 
-        try:
-            host = attrs['history_records_history_hostname']
-        except KeyError:
-            host = None
+    def update_snapshot(self, attrs):
+        """
+        Replaces the snapshot with the given Monitor attributes and
+        updates the state and public IP addresses from them.
+        """
+        self._snapshot = attrs
+        self._snapshot_time = time.time()
 
-        return host
+        self.state = StratusLabNodeDriver._attrs_to_state(attrs)
 
-    def get_vm_info(self):
-        configHolder = \
-            StratusLabNodeDriver.get_config_section(self.location,
-                                                    self.driver.user_configurator)
-        monitor = Monitor(configHolder)
+        public_ips = StratusLabNodeDriver._attrs_to_public_ips(attrs)
+        if public_ips:
+            self.public_ips = public_ips
+
+    def invalidate(self):
+        """
+        Marks the snapshot and cached state as stale, so that the next
+        read of the state or host will query the Monitor.
+        """
+        self._cached_state_time = None
+        self._snapshot_time = None
 
-        vm_infos = monitor.vmDetail([self.id])
+    def get_vm_info(self):
+        with self.driver._monitor(self.location) as monitor:
+            with self.driver._timer('vmDetail', self.location):
+                vm_infos = monitor.vmDetail([self.id])
         if len(vm_infos) == 0:
             raise ValueError('cannot recover state information for %s' % self.id)
 
         return vm_infos[0]
 
     def get_node_state(self):
-        vm_info = self.get_vm_info()
+        return self.refresh()
 
-        attrs = vm_info.getAttributes()
 
-        try:
-            state_summary = attrs['state_summary']
-        except KeyError:
-            state_summary = None
+class StratusLabNodeRecord(object):
+    """
+    Compact, read-only record of a node for large listings.  Only
+    the essential fields are kept (in slots, without a per-instance
+    dictionary); the location, size and image are references to the
+    objects shared by the driver.  The record can be converted to a
+    full StratusLabNode with to_node() when needed.
+    """
 
-        return StratusLabNodeDriver._to_node_state(state_summary)
+    __slots__ = ('id', 'name', 'state', 'public_ip',
+                 'location', 'size', 'image', 'driver')
+
+    def __init__(self, node_id, name, state, public_ip, location,
+                 size, image, driver):
+        self.id = str(node_id) if node_id else None
+        self.name = name
+        self.state = state
+        self.public_ip = public_ip
+        self.location = location
+        self.size = size
+        self.image = image
+        self.driver = driver
+
+    @property
+    def public_ips(self):
+        if self.public_ip:
+            return [self.public_ip]
+        else:
+            return []
+
+    def to_node(self, attrs=None):
+        """
+        Returns a new StratusLabNode with the information from this
+        record.  If the Monitor attributes from which the record was
+        built are given, they become the snapshot of the node, so that
+        reading its host or state does not query the Monitor again.
+        """
+        node = StratusLabNode(self.id,
+                              self.name,
+                              self.state,
+                              self.public_ips,
+                              None,
+                              self.driver,
+                              size=self.size,
+                              image=self.image,
+                              extra={'location': self.location})
+        if attrs is not None:
+            node.update_snapshot(attrs)
+        return node
+
+    def __repr__(self):
+        return ('<StratusLabNodeRecord: id=%s, name=%s, state=%s, '
+                'public_ip=%s, location=%s>' %
+                (self.id, self.name, self.state, self.public_ip,
+                 getattr(self.location, 'id', None)))
+
+
+class StratusLabNodeDelta(object):
+    """
+    Result of an incremental refresh of the nodes in a location: the
+    complete list of current nodes along with the nodes that have
+    been added, removed or changed since the previous refresh.
+    """
+
+    def __init__(self, location, nodes, added, removed, changed):
+        self.location = location
+        self.nodes = nodes
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+
+    def __repr__(self):
+        return ('<StratusLabNodeDelta: location=%s, nodes=%d, added=%d, '
+                'removed=%d, changed=%d>' %
+                (self.location.id, len(self.nodes), len(self.added),
+                 len(self.removed), len(self.changed)))
 
 
 class StratusLabNodeDriver(NodeDriver):
@@ -146,10 +327,40 @@ class StratusLabNodeDriver(NodeDriver):
 
     DEFAULT_MARKETPLACE_URL = 'https://marketplace.stratuslab.eu'
 
+    DEFAULT_STATE_TTL = 5
+
+    DEFAULT_MAX_WORKERS = 8
+
+    # Polling intervals (in seconds) used by wait_until_running for
+    # the machine states preceding 'running'.  Scheduling (pending)
+    # and boot are usually short; prolog copies the image to the
+    # host and commonly lasts minutes.
+    WAIT_INTERVALS = {'pending': 2, 'prolog': 10, 'boot': 2}
+
+    WAIT_BACKOFF = 1.5
+
+    WAIT_MAX_INTERVAL = 30
+
+    # Monitor attributes that describe a node, as opposed to usage
+    # counters (CPU, memory, network, last poll) that change with
+    # every listing.
+    PROJECTION_ATTRIBUTES = ('state_summary', 'template_nic_ip', 'name',
+                             'template_cpu', 'template_memory',
+                             'template_disk_size', 'template_disk_source',
+                             'history_records_history_hostname')
+
     user_configurator = None
     locations = None
     default_location = None
     sizes = None
+    state_ttl = DEFAULT_STATE_TTL
+    max_workers = DEFAULT_MAX_WORKERS
+    location_timeout = None
+    list_nodes_errors = None
+    marketplace_cache = None
+    registry = None
+    metrics = NullMetrics()
+    watch_interval = NodeWatcher.DEFAULT_INTERVAL
 
     def __init__(self, key, secret=None, secure=False, host=None, port=None,
                  api_version=None, **kwargs):
@@ -179,6 +390,65 @@ class StratusLabNodeDriver(NodeDriver):
         the section within the user configuration file to use as the
         default location.
 
+        :keyword stratuslab_state_ttl (float): Number of seconds that
+        the state of a node is cached before the Monitor is queried
+        again.  A value of None or 0 disables the cache.  Defaults to
+        DEFAULT_STATE_TTL.
+
+        :keyword stratuslab_max_workers (int): Maximum number of
+        locations that are queried concurrently.  Defaults to
+        DEFAULT_MAX_WORKERS.
+
+        :keyword stratuslab_location_timeout (float): Number of seconds
+        to wait for the response of a single location when listing
+        nodes.  Defaults to None (no timeout).
+
+        :keyword stratuslab_marketplace_cache_dir (str): Directory
+        used to cache the Marketplace metadata.  The directory can be
+        shared between processes.  Defaults to
+        MarketplaceCache.DEFAULT_CACHE_DIR.  A value of None disables
+        the cache.
+
+        :keyword stratuslab_marketplace_max_age (float): Number of
+        seconds that cached Marketplace metadata is used without
+        revalidating it with the server.  Defaults to
+        MarketplaceCache.DEFAULT_MAX_AGE.
+
+        :keyword stratuslab_client_idle_timeout (float): Number of
+        seconds after which an unused Monitor or PersistentDisk client
+        (and its connection) is discarded rather than reused.
+        Defaults to ServiceClientPool.DEFAULT_IDLE_TIMEOUT.  Idle
+        clients are discarded at most this often, so that clients of
+        locations that are no longer used do not stay open.
+
+        :keyword stratuslab_client_health_check (callable): Function
+        called with a Monitor or PersistentDisk client before it is
+        reused; a client for which it returns False (or raises an
+        exception) is discarded and a new one is created.  Defaults to
+        None (no check).
+
+        :keyword stratuslab_watch_interval (float): Number of seconds
+        between two polls of a location by the shared poller used by
+        ex_watch_location and ex_watch_nodes.  Defaults to
+        NodeWatcher.DEFAULT_INTERVAL.
+
+        :keyword stratuslab_registry (str): Name of a SQLite database
+        file in which the listed nodes and Marketplace images are
+        recorded.  The recorded nodes are available immediately from
+        ex_list_cached_nodes and the recorded images are used by
+        get_image.  Defaults to None (no registry).
+
+        :keyword stratuslab_registry_reconcile (bool): Whether all of
+        the locations are listed in a background thread at startup to
+        bring the registry up to date.  Defaults to True.
+
+        :keyword stratuslab_metrics (object): Metrics backend, for
+        example a metrics.HistogramMetrics instance.  Each call to a
+        StratusLab service (Monitor, Runner, PersistentDisk,
+        Marketplace) is wrapped in the context manager returned by
+        its timer(operation, location) method.  Defaults to a backend
+        that records nothing.
+
         :returns: StratusLabNodeDriver
 
         """
@@ -200,14 +470,71 @@ class StratusLabNodeDriver(NodeDriver):
         user_config_file = kwargs.get('stratuslab_user_config',
                                       StratusLabUtil.defaultConfigFileUser)
         default_section = kwargs.get('stratuslab_default_location', None)
-
+        self.state_ttl = kwargs.get('stratuslab_state_ttl',
+                                    self.DEFAULT_STATE_TTL)
+        self.max_workers = kwargs.get('stratuslab_max_workers',
+                                      self.DEFAULT_MAX_WORKERS)
+        self.location_timeout = kwargs.get('stratuslab_location_timeout', None)
+        self._worker_pool_lock = threading.Lock()
+        self._worker_pool = None
+
+        cache_dir = kwargs.get('stratuslab_marketplace_cache_dir',
+                               MarketplaceCache.DEFAULT_CACHE_DIR)
+        if cache_dir is not None:
+            max_age = kwargs.get('stratuslab_marketplace_max_age',
+                                 MarketplaceCache.DEFAULT_MAX_AGE)
+            self.marketplace_cache = MarketplaceCache(cache_dir, max_age)
+
+        self._image_catalogs = {}
+
+        self.metrics = kwargs.get('stratuslab_metrics', None) or NullMetrics()
+
+        self.watch_interval = kwargs.get('stratuslab_watch_interval',
+                                         NodeWatcher.DEFAULT_INTERVAL)
+        self._watcher_lock = threading.Lock()
+        self._node_watcher = None
+
+        self._inventory_lock = threading.Lock()
+        self._inventory = {}
+
+        self._user_config_file = user_config_file
         self.user_configurator = UserConfigurator(configFile=user_config_file)
 
+        self._client_pool = ServiceClientPool(
+            idle_timeout=kwargs.get('stratuslab_client_idle_timeout',
+                                    ServiceClientPool.DEFAULT_IDLE_TIMEOUT),
+            health_check=kwargs.get('stratuslab_client_health_check', None))
+        self._last_eviction = time.time()
+
+        self._config_lock = threading.Lock()
+        self._config_stamp = self._config_file_stamp()
+        self._location_configs = {}
+
         self.default_location, self.locations = \
             self._get_config_locations(default_section)
 
         self.sizes = self._get_config_sizes()
 
+        # Flyweights for the sizes and images of listed nodes.
+        self._shared_sizes = {}
+        for size in self.sizes:
+            shape = self._size_shape(size.cpu, size.ram, size.disk)
+            self._shared_sizes.setdefault(shape, size)
+        self._shared_images = {}
+
+        self._registry_nodes = {}
+        self._registry_thread = None
+        registry_path = kwargs.get('stratuslab_registry', None)
+        if registry_path is not None:
+            self.registry = NodeRegistry(registry_path)
+            self._load_registry()
+            if kwargs.get('stratuslab_registry_reconcile', True):
+                self._registry_thread = threading.Thread(
+                    target=self._reconcile_registry,
+                    name='stratuslab-registry')
+                self._registry_thread.daemon = True
+                self._registry_thread.start()
+
     # noinspection PyUnusedLocal
     def get_uuid(self, unique_field=None):
         """
@@ -223,6 +550,10 @@ class StratusLabNodeDriver(NodeDriver):
         config = UserConfigurator.userConfiguratorToDictWithFormattedKeys(user_configurator,
                                                                           selected_section=location.id)
 
+        return StratusLabNodeDriver._create_config_holder(config, options)
+
+    @staticmethod
+    def _create_config_holder(config, options=None):
         options = options or {}
         options['verboseLevel'] = -1
         options['verbose_level'] = -1
@@ -233,10 +564,95 @@ class StratusLabNodeDriver(NodeDriver):
         return configHolder
 
     def _get_config_section(self, location, options=None):
+        """
+        Returns a ConfigHolder for the given location.  The formatted
+        configuration of each location is computed only once (until
+        the configuration file changes); each holder receives its own
+        copy of it, so callers may modify the returned holder freely.
+
+        """
+        location = location or self.default_location
+        config = self._get_location_config(location)
+        return StratusLabNodeDriver._create_config_holder(dict(config), options)
+
+    def _get_location_config(self, location):
+        with self._config_lock:
+            stamp = self._config_file_stamp()
+            if stamp != self._config_stamp:
+                if self._config_stamp is not None:
+                    self.user_configurator = UserConfigurator(configFile=self._user_config_file)
+                self._config_stamp = stamp
+                self._location_configs = {}
+                self._client_pool.clear()
+
+            try:
+                return self._location_configs[location.id]
+            except KeyError:
+                config = UserConfigurator.userConfiguratorToDictWithFormattedKeys(self.user_configurator,
+                                                                                  selected_section=location.id)
+                self._location_configs[location.id] = config
+                return config
+
+    def _config_file_stamp(self):
+        """
+        Returns a value identifying the current version of the user
+        configuration file.  File-like objects are never re-read, so
+        their identity is sufficient.
+
+        """
+        config_file = self._user_config_file
+        if isinstance(config_file, basestring):
+            try:
+                stat = os.stat(config_file)
+                return config_file, stat.st_ino, stat.st_size, stat.st_mtime
+            except OSError:
+                return config_file, None
+        else:
+            return id(config_file)
+
+    def _monitor(self, location=None):
+        """
+        Context manager providing a Monitor for the given location
+        from the pool of service clients.
+
+        """
+        return self._service_client(Monitor, location)
+
+    def _pdisk(self, location=None):
+        """
+        Context manager providing a PersistentDisk client for the
+        given location from the pool of service clients.
+
+        """
+        return self._service_client(PersistentDisk, location)
+
+    def _timer(self, operation, location=None):
+        """
+        Returns the metrics timer for the operation in the given
+        location (the default location if None).
+
+        """
+        location = location or self.default_location
+        return self.metrics.timer(operation, location.id)
+
+    def _service_client(self, service, location):
         location = location or self.default_location
-        return StratusLabNodeDriver.get_config_section(location,
-                                                       self.user_configurator,
-                                                       options)
+
+        # Also detects changes to the configuration file, which
+        # empty the pool.
+        self._get_location_config(location)
+
+        # Idle clients are otherwise only discarded when their key is
+        # used again.
+        now = time.time()
+        if now - self._last_eviction >= self._client_pool.idle_timeout:
+            self._last_eviction = now
+            self._client_pool.evict_idle()
+
+        def factory():
+            return service(self._get_config_section(location))
+
+        return self._client_pool.client((service, location.id), factory)
 
     def _get_config_locations(self, default_section=None):
         """
@@ -333,69 +749,733 @@ class StratusLabNodeDriver(NodeDriver):
                                   driver=self,
                                   cpu=cpu)
 
-    def list_nodes(self):
+    def list_nodes(self, ex_compact=False):
         """
         List the nodes (machine instances) that are active in all
-        locations.
+        locations.  If ex_compact is True, compact
+        StratusLabNodeRecord objects are returned instead of nodes.
+
+        The locations are queried concurrently.  If the requests for
+        some locations fail (or time out), the nodes from the other
+        locations are still returned and the errors are available in
+        the list_nodes_errors attribute, a dictionary keyed by the
+        location id.  An exception is raised only if all of the
+        locations fail.
 
         """
 
-        nodes = []
-        for location in self.locations.values():
-            nodes.extend(self.list_nodes_in_location(location))
+        nodes, errors = self.ex_list_nodes(compact=ex_compact)
+
+        self.list_nodes_errors = errors
+        if errors and len(errors) == len(self.locations):
+            raise errors.values()[0]
+
         return nodes
 
-    def list_nodes_in_location(self, location):
+    def ex_list_nodes(self, locations=None, timeout=None, compact=False):
         """
         List the nodes (machine instances) that are active in the
-        given location.
+        given locations (all locations by default).  At most
+        max_workers locations are queried concurrently.
+
+        The timeout (in seconds) applies separately to the request
+        for each location; the value of location_timeout is used if
+        it is not given.  A value of None means no timeout.
 
+        Returns a tuple containing the list of nodes from all of the
+        locations that responded and a dictionary of the exceptions
+        raised by the failing locations keyed by the location id.  If
+        compact is True, the list contains StratusLabNodeRecord
+        objects instead of nodes.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
         """
 
-        configHolder = self._get_config_section(location)
+        if locations is None:
+            locations = self.locations.values()
 
-        monitor = Monitor(configHolder)
-        vms = monitor.listVms()
+        def list_location(location):
+            return self.list_nodes_in_location(location, ex_compact=compact)
 
         nodes = []
+        errors = {}
+        for location, location_nodes, error in \
+                self._map_locations(list_location, locations,
+                                    timeout=timeout):
+            if error is not None:
+                errors[location.id] = error
+            else:
+                nodes.extend(location_nodes)
+
+        return nodes, errors
+
+    def _map_locations(self, func, locations, timeout=None):
+        """
+        Applies the function to each of the locations using the pool of
+        max_workers threads of the driver.  This generator yields tuples
+        of (location, result, error) in the order in which the calls
+        complete.  The error is None for successful calls.  Calls that
+        do not finish within the timeout (measured from the start of
+        the call) are yielded with an error and their results are
+        discarded.
+
+        """
+
+        locations = list(locations)
+        if not locations:
+            return
+
+        if timeout is None:
+            timeout = self.location_timeout
+
+        results = Queue.Queue()
+        started = {}
+
+        def run(location):
+            started[location.id] = time.time()
+            try:
+                results.put((location, func(location), None))
+            except Exception as e:
+                results.put((location, None, e))
+
+        workers = min(self.max_workers, len(locations))
+
+        # Calls that have not started when all of the workers are busy
+        # with slower locations must also expire eventually.
+        submitted = time.time()
+        queued_deadlines = {}
+        if timeout is not None:
+            for i, location in enumerate(locations):
+                queued_deadlines[location.id] = \
+                    submitted + timeout * (1 + i // workers)
+
+        def deadline(location_id):
+            try:
+                return started[location_id] + timeout
+            except KeyError:
+                return queued_deadlines[location_id]
+
+        pool = self._get_worker_pool()
+        for location in locations:
+            pool.apply_async(run, (location,))
+
+        # Calls that have timed out are not waited for; they keep their
+        # worker until they return, rather than leaving a thread behind
+        # for every call.
+        pending = dict([(location.id, location) for location in locations])
+        while pending:
+            wait = None
+            if timeout is not None:
+                next_deadline = min([deadline(location_id)
+                                     for location_id in pending.keys()])
+                wait = max(next_deadline - time.time(), 0)
+
+            try:
+                location, result, error = results.get(timeout=wait)
+            except Queue.Empty:
+                now = time.time()
+                for location_id, location in pending.items():
+                    if deadline(location_id) <= now:
+                        del pending[location_id]
+                        error = Exception('timeout for location %s'
+                                          % location_id)
+                        yield location, None, error
+                continue
+
+            if location.id in pending:
+                del pending[location.id]
+                yield location, result, error
+
+    def _get_worker_pool(self):
+        """
+        Returns the pool of max_workers threads used for the requests
+        to several locations, creating it on first use.
+        """
+        with self._worker_pool_lock:
+            if self._worker_pool is None:
+                self._worker_pool = ThreadPool(self.max_workers)
+            return self._worker_pool
+
+    def list_nodes_in_location(self, location, ex_compact=False):
+        """
+        List the nodes (machine instances) that are active in the
+        given location.  If ex_compact is True, compact
+        StratusLabNodeRecord objects are returned instead of nodes.
+
+        """
+
+        vms = self._list_vms(location)
+
+        records = []
+        snapshots = []
         for vm_info in vms:
-            nodes.append(self._vm_info_to_node(vm_info, location))
+            attrs = vm_info.getAttributes()
+            records.append(self._attrs_to_record(attrs, location))
+            if not ex_compact:
+                snapshots.append(attrs)
+
+        if self.registry is not None:
+            self._record_nodes(location, records)
+
+        if ex_compact:
+            return records
+        return [record.to_node(attrs) for record, attrs in zip(records, snapshots)]
+
+    def ex_iter_nodes(self, locations=None, state=None, image=None,
+                      name=None, compact=False, timeout=None, errors=None):
+        """
+        Generator that yields the nodes of the given locations (all
+        locations by default) as soon as each location has answered,
+        in the order in which the locations complete.  The locations
+        are queried concurrently as for ex_list_nodes.
+
+        The state, image and name arguments select the nodes to
+        return; they are applied to the raw Monitor information before
+        any node object is created.  Each may be a single value (a
+        NodeState, a Marketplace image identifier, a node name), a
+        list/tuple/set of accepted values, or a function taking the
+        value and returning a boolean.  None accepts everything.
+
+        If compact is True, StratusLabNodeRecord objects are yielded
+        instead of nodes.  If a dictionary is given for errors, the
+        exceptions of the failing locations are stored in it, keyed
+        by location id; otherwise failing locations are skipped.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+
+        if locations is None:
+            locations = self.locations.values()
+
+        for location, vms, error in \
+                self._map_locations(self._list_vms, locations, timeout=timeout):
+            if error is not None:
+                if errors is not None:
+                    errors[location.id] = error
+                continue
+
+            for vm_info in vms:
+                attrs = vm_info.getAttributes()
+
+                if not (self._matches(state, self._attrs_to_state(attrs)) and
+                        self._matches(image, self._attrs_to_image_id(attrs)) and
+                        self._matches(name, attrs['name'] or None)):
+                    continue
+
+                record = self._attrs_to_record(attrs, location)
+                if compact:
+                    yield record
+                else:
+                    yield record.to_node(attrs)
+
+    def ex_refresh_nodes(self, location=None):
+        """
+        Lists the nodes in the given location (the default location
+        if None) and compares them with the result of the previous
+        call for that location.  Only the attributes describing a
+        node (see _attrs_projection) are compared; counters such as
+        the CPU and network usage are ignored.  Node objects are
+        reused across calls: the snapshots of all of the known nodes
+        are updated in place and only added machines produce new node
+        objects.
+
+        Returns a StratusLabNodeDelta.  On the first call for a
+        location, all of the nodes are reported as added.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+        location = location or self.default_location
+
+        current = {}
+        projections = {}
+        for vm_info in self._list_vms(location):
+            vm_attrs = vm_info.getAttributes()
+            current[str(vm_attrs['id'])] = vm_attrs
+            projections[str(vm_attrs['id'])] = self._attrs_projection(vm_attrs)
+
+        with self._inventory_lock:
+            previous = self._inventory.get(location.id, {})
+
+            added_ids, removed_ids, changed_ids = \
+                diff_snapshots(dict([(node_id, projection)
+                                     for node_id, (projection, _)
+                                     in previous.items()]),
+                               projections)
+
+            inventory = {}
+            added = []
+            changed = []
+            for node_id, attrs in current.items():
+                if node_id in added_ids:
+                    node = self._attrs_to_record(attrs, location).to_node(attrs)
+                    added.append(node)
+                else:
+                    node = previous[node_id][1]
+                    if node_id in changed_ids:
+                        changed.append(node)
+                    node.update_snapshot(attrs)
+                inventory[node_id] = (projections[node_id], node)
+
+            removed = [previous[node_id][1] for node_id in removed_ids]
+
+            self._inventory[location.id] = inventory
+
+        nodes = [entry[1] for entry in inventory.values()]
+        return StratusLabNodeDelta(location, nodes, added, removed, changed)
+
+    def ex_list_cached_nodes(self, locations=None, compact=False):
+        """
+        Returns the nodes of the given locations (all locations by
+        default) as last recorded in the registry, without contacting
+        the locations.  The nodes are those of the last listing made
+        by this driver or by another process sharing the registry
+        file; their states may be out of date.  Returns an empty list
+        if there is no registry.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+        if locations is None:
+            locations = self.locations.values()
+
+        nodes = []
+        for location in locations:
+            records = self._registry_nodes.get(location.id, [])
+            if compact:
+                nodes.extend(records)
+            else:
+                nodes.extend([record.to_node() for record in records])
 
         return nodes
 
+    def ex_reconcile_registry(self, locations=None, timeout=None):
+        """
+        Lists the nodes of the given locations (all locations by
+        default) to bring the registry up to date.  Returns a
+        dictionary of the exceptions raised by the failing locations,
+        whose recorded nodes are left untouched.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+        _, errors = self.ex_list_nodes(locations=locations, timeout=timeout,
+                                       compact=True)
+        return errors
+
+    def _reconcile_registry(self):
+        try:
+            self.ex_reconcile_registry()
+        except Exception:
+            _log.exception('cannot reconcile the node registry')
+
+    def _load_registry(self):
+        for location_id, rows in self.registry.load_nodes().items():
+            location = self.locations.get(location_id)
+            if location is None:
+                continue
+            records = []
+            for row in rows:
+                records.append(self._row_to_record(row, location))
+            self._registry_nodes[location_id] = records
+
+        for url, rows in self.registry.load_images().items():
+            catalog = ImageCatalog()
+            for row in rows:
+                extra = {'title': row['title'],
+                         'description': row['description']}
+                image = NodeImage(id=row['image_id'], name=row['name'] or '',
+                                  driver=self, extra=extra)
+                self._add_to_catalog(catalog, image)
+            # the Marketplace may have changed since the images were
+            # recorded, so the catalog is not complete
+            self._image_catalogs[url] = catalog
+
+    def _record_nodes(self, location, records):
+        self._registry_nodes[location.id] = records
+
+        rows = []
+        for record in records:
+            rows.append(self._record_to_row(record))
+        try:
+            self.registry.save_nodes(location.id, rows)
+        except Exception:
+            # the listing itself has succeeded
+            _log.exception('cannot record the nodes of location %s', location.id)
+
+    @staticmethod
+    def _record_to_row(record):
+        size = record.size
+        return {'node_id': record.id,
+                'name': record.name,
+                'state': record.state,
+                'public_ip': record.public_ip,
+                'cpu': getattr(size, 'cpu', None),
+                'ram': getattr(size, 'ram', None),
+                'disk': getattr(size, 'disk', None),
+                'image_id': getattr(record.image, 'id', None)}
+
+    def _row_to_record(self, row, location):
+        size = self._get_shared_size(row['cpu'], row['ram'], row['disk'])
+        return StratusLabNodeRecord(row['node_id'],
+                                    row['name'],
+                                    row['state'],
+                                    row['public_ip'],
+                                    location,
+                                    size,
+                                    self._get_shared_image(row['image_id']),
+                                    self)
+
+    def ex_watch_location(self, location=None, node_ids=None, callback=None,
+                          queue=None):
+        """
+        Registers a watcher for the nodes in the given location (the
+        default location if None), either all of them or only those
+        with the given ids.  Changes of the nodes (see NodeEvent) are
+        passed to the callback, called from a background thread,
+        and/or put on the given queue.  The first events describe the
+        current nodes.
+
+        All of the watchers of a location share one background poller
+        that lists the location every watch_interval seconds.
+
+        Returns a Subscription; call its cancel() method (or
+        ex_unwatch) to stop watching.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+        location = location or self.default_location
+        return self._get_node_watcher().subscribe(location,
+                                                  node_ids=node_ids,
+                                                  callback=callback,
+                                                  queue=queue)
+
+    def ex_watch_nodes(self, nodes, callback=None, queue=None):
+        """
+        Registers a watcher for the given nodes, as for
+        ex_watch_location.  Returns a list of Subscriptions, one for
+        each location of the nodes.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+        groups = {}
+        for node in nodes:
+            location = getattr(node, 'location', None) or self.default_location
+            groups.setdefault(location.id, (location, []))[1].append(node.id)
+
+        subscriptions = []
+        for location, node_ids in groups.values():
+            subscriptions.append(self.ex_watch_location(location,
+                                                        node_ids=node_ids,
+                                                        callback=callback,
+                                                        queue=queue))
+        return subscriptions
+
+    def ex_unwatch(self, subscription):
+        """
+        Cancels a subscription returned by ex_watch_location or
+        ex_watch_nodes.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+        subscription.cancel()
+
+    def ex_watch_error(self, location=None):
+        """
+        Returns the exception raised by the last poll of the watched
+        location (the default location if None), or None if that poll
+        succeeded or the location is not watched.  A watcher receives
+        no events while the polls of its location fail.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+        location = location or self.default_location
+        with self._watcher_lock:
+            watcher = self._node_watcher
+        if watcher is None:
+            return None
+        return watcher.last_error(location)
+
+    def _get_node_watcher(self):
+        with self._watcher_lock:
+            if self._node_watcher is None:
+                self._node_watcher = NodeWatcher(self._watch_snapshot,
+                                                 interval=self.watch_interval)
+            return self._node_watcher
+
+    def _watch_snapshot(self, location):
+        snapshot = {}
+        for vm_info in self._list_vms(location):
+            attrs = vm_info.getAttributes()
+            public_ips = self._attrs_to_public_ips(attrs)
+            public_ip = public_ips and public_ips[0] or None
+            snapshot[str(attrs['id'])] = (self._attrs_to_state(attrs), public_ip)
+        return snapshot
+
+    @staticmethod
+    def _matches(predicate, value):
+        if predicate is None:
+            return True
+        elif callable(predicate):
+            return predicate(value)
+        elif isinstance(predicate, (list, tuple, set, frozenset)):
+            return value in predicate
+        else:
+            return value == predicate
+
+    def _list_vms(self, location):
+        with self._monitor(location) as monitor:
+            with self._timer('listVms', location):
+                return monitor.listVms()
+
+    def _attrs_to_record(self, attrs, location):
+        public_ips = StratusLabNodeDriver._attrs_to_public_ips(attrs)
+        if public_ips:
+            public_ip = public_ips[0]
+        else:
+            public_ip = None
+
+        size = self._get_shared_size(attrs['template_cpu'],
+                                     attrs['template_memory'],
+                                     attrs['template_disk_size'])
+
+        mp_id = StratusLabNodeDriver._attrs_to_image_id(attrs)
+
+        return StratusLabNodeRecord(attrs['id'] or None,
+                                    attrs['name'] or None,
+                                    StratusLabNodeDriver._to_node_state(attrs['state_summary'] or None),
+                                    public_ip,
+                                    location,
+                                    size,
+                                    self._get_shared_image(mp_id),
+                                    self)
+
     def _vm_info_to_node(self, vm_info, location):
         attrs = vm_info.getAttributes()
-        node_id = attrs['id'] or None
-        name = attrs['name'] or None
-        state = StratusLabNodeDriver._to_node_state(attrs['state_summary'] or None)
+        return self._attrs_to_record(attrs, location).to_node(attrs)
 
-        public_ip = attrs['template_nic_ip']
-        if public_ip:
-            public_ips = [public_ip]
-        else:
-            public_ips = []
+    def ex_get_nodes_details(self, nodes):
+        """
+        Recovers the state, host, and public IP addresses of all of
+        the given nodes.  The nodes are grouped by location and a
+        single Monitor request is made for each location, rather than
+        one request per node.  The snapshot of each given node is
+        updated (see StratusLabNode), so that reading its state, host
+        or IP addresses afterwards does not query the Monitor again.
+
+        Returns a dictionary keyed by node id.  The values are
+        dictionaries with 'state', 'state_summary' (the raw machine
+        state), 'host', and 'public_ips' keys.
+        Nodes for which the Monitor returns no information are not
+        included in the result.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+
+        groups = {}
+        for node in nodes:
+            location = getattr(node, 'location', None) or self.default_location
+            groups.setdefault(location.id, (location, []))[1].append(node)
+
+        details = {}
+        for location, location_nodes in groups.values():
+            with self._monitor(location) as monitor:
+                with self._timer('vmDetail', location):
+                    vm_infos = monitor.vmDetail([node.id for node in location_nodes])
+            snapshots = {}
+            for vm_info in vm_infos:
+                attrs = vm_info.getAttributes()
+                snapshots[str(attrs['id'])] = attrs
+                details[str(attrs['id'])] = self._attrs_to_details(attrs)
+
+            for node in location_nodes:
+                try:
+                    attrs = snapshots[node.id]
+                except KeyError:
+                    continue
+                if isinstance(node, StratusLabNode):
+                    node.update_snapshot(attrs)
+                else:
+                    node.state = details[node.id]['state']
+
+        return details
+
+    def wait_until_running(self, nodes, wait_period=3, timeout=600,
+                           ssh_interface='public_ips', force_ipv4=True):
+        """
+        Blocks until all of the given nodes are running and have an
+        IP address on the given interface.  Unlike the generic
+        implementation, only the locations of the given nodes are
+        polled, with one Monitor request per location per tick (see
+        ex_get_nodes_details).
+
+        The polling interval adapts to the state of the nodes: it is
+        taken from WAIT_INTERVALS for the least advanced machine state
+        ('prolog', the image transfer, is much longer than the other
+        phases) and grows by WAIT_BACKOFF, up to WAIT_MAX_INTERVAL,
+        while the states do not change.  The wait_period is used for
+        states that are not listed in WAIT_INTERVALS.
+
+        Returns a list of (node, ip_addresses) tuples in the same
+        order as the given nodes.  Raises LibcloudError if a node is
+        terminated or if the timeout is reached.
+
+        @inherits: L{NodeDriver.wait_until_running}
+        """
+
+        end = time.time() + timeout
+
+        waiting = dict([(node.id, node) for node in nodes])
+        addresses = {}
+
+        previous_states = None
+        interval = None
+
+        while True:
+            details = self.ex_get_nodes_details(waiting.values())
+
+            states = {}
+            for node_id, node in waiting.items():
+                node_details = details.get(node_id)
+                if node_details is None:
+                    # not (yet) known to the Monitor
+                    states[node_id] = None
+                    continue
+
+                if node_details['state'] == NodeState.TERMINATED:
+                    raise LibcloudError(value='node %s has been terminated' % node_id,
+                                        driver=self)
+
+                ips = getattr(node, ssh_interface) or []
+                if force_ipv4:
+                    ips = [ip for ip in ips if self._is_ipv4_address(ip)]
+
+                if node_details['state'] == NodeState.RUNNING and ips:
+                    addresses[node_id] = ips
+                    del waiting[node_id]
+                else:
+                    states[node_id] = node_details['state_summary']
+
+            if not waiting:
+                return [(node, addresses[node.id]) for node in nodes]
+
+            if interval is not None and states == previous_states:
+                interval = min(interval * self.WAIT_BACKOFF,
+                               self.WAIT_MAX_INTERVAL)
+            else:
+                interval = min([self.WAIT_INTERVALS.get((state or '').lower(),
+                                                        wait_period)
+                                for state in states.values()])
+            previous_states = states
+
+            remaining = end - time.time()
+            if remaining <= 0:
+                raise LibcloudError(value='Timed out after %s seconds' % timeout,
+                                    driver=self)
+
+            time.sleep(min(interval, remaining))
+
+    @staticmethod
+    def _is_ipv4_address(address):
+        try:
+            socket.inet_aton(address)
+        except (socket.error, TypeError):
+            return False
+        return address.count('.') == 3
+
+    def _get_shared_size(self, cpu, ram, swap):
+        """
+        Returns the node size for the given resources.  Sizes are
+        shared between all of the nodes with the same resources.  The
+        named size from list_sizes() is used when the resources match
+        one; otherwise a size named after the resources is created
+        once and reused.
+
+        """
+        shape = StratusLabNodeDriver._size_shape(cpu, ram, swap)
+        try:
+            return self._shared_sizes[shape]
+        except KeyError:
+            name = 'custom_%s_%s_%s' % shape
+            size = self._create_node_size(name, shape)
+            return self._shared_sizes.setdefault(shape, size)
 
-        size_name = '%s_size' % node_id
+    @staticmethod
+    def _size_shape(cpu, ram, swap):
+        shape = []
+        for value in (cpu, ram, swap):
+            try:
+                shape.append(int(value))
+            except (TypeError, ValueError):
+                shape.append(value)
+        return tuple(shape)
+
+    def _get_shared_image(self, image_id):
+        """
+        Returns the image with the given Marketplace identifier,
+        taking it from the image catalogs if it has already been
+        listed.  Otherwise, a minimal image (named after its
+        identifier) is created once and reused for all nodes.
+
+        """
+        for catalog in self._image_catalogs.values():
+            image = catalog.get(image_id)
+            if image is not None:
+                return image
 
-        cpu = attrs['template_cpu']
-        ram = attrs['template_memory']
-        swap = attrs['template_disk_size']
+        try:
+            return self._shared_images[image_id]
+        except KeyError:
+            image = NodeImage(image_id, image_id, self)
+            return self._shared_images.setdefault(image_id, image)
+
+    @staticmethod
+    def _attrs_to_details(attrs):
+        return {'state': StratusLabNodeDriver._attrs_to_state(attrs),
+                'state_summary': attrs.get('state_summary'),
+                'host': StratusLabNodeDriver._attrs_to_host(attrs),
+                'public_ips': StratusLabNodeDriver._attrs_to_public_ips(attrs)}
 
-        size = self._create_node_size(size_name, (cpu, ram, swap))
+    @staticmethod
+    def _attrs_projection(attrs):
+        return tuple([attrs.get(key)
+                      for key in StratusLabNodeDriver.PROJECTION_ATTRIBUTES])
 
+    @staticmethod
+    def _attrs_to_state(attrs):
+        try:
+            state_summary = attrs['state_summary']
+        except KeyError:
+            state_summary = None
+
+        return StratusLabNodeDriver._to_node_state(state_summary)
+
+    @staticmethod
+    def _attrs_to_host(attrs):
+        try:
+            return attrs['history_records_history_hostname']
+        except KeyError:
+            return None
+
+    @staticmethod
+    def _attrs_to_image_id(attrs):
         mp_url = attrs['template_disk_source']
-        mp_id = mp_url.split('/')[-1]
-        image = NodeImage(mp_id, mp_id, self)
+        return mp_url.split('/')[-1]
 
-        return StratusLabNode(node_id,
-                              name,
-                              state,
-                              public_ips,
-                              None,
-                              self,
-                              size=size,
-                              image=image,
-                              extra={'location': location})
+    @staticmethod
+    def _attrs_to_public_ips(attrs):
+        public_ip = attrs.get('template_nic_ip')
+        if public_ip:
+            return [public_ip]
+        else:
+            return []
 
     @staticmethod
     def _to_node_state(state):
@@ -439,6 +1519,23 @@ class StratusLabNodeDriver(NodeDriver):
 
         """
 
+        return self.ex_create_nodes(1, **kwargs)[0]
+
+    def ex_create_nodes(self, count, **kwargs):
+        """
+        Creates count identical nodes with a single submission to the
+        cloud.  The keywords are the same as for create_node.  The
+        network details of all of the new nodes are then recovered
+        with one Monitor request (see ex_get_nodes_details); nodes
+        for which no IP address is yet known have an empty list of
+        public IPs.
+
+        Returns the list of newly created nodes.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+
         name = kwargs.get('name')
         size = kwargs.get('size')
         image = kwargs.get('image')
@@ -446,33 +1543,34 @@ class StratusLabNodeDriver(NodeDriver):
         auth = kwargs.get('auth', None)
 
         runner = self._create_runner(name, size, image,
-                                     location=location, auth=auth)
-
-        ids = runner.runInstance()
-        node_id = ids[0]
+                                     location=location, auth=auth,
+                                     count=count)
 
-        extra = {'location': location}
+        with self._timer('runInstance', location):
+            ids = runner.runInstance()
 
-        node = StratusLabNode(node_id=node_id,
-                              name=name,
-                              state=NodeState.PENDING,
-                              public_ips=[],
-                              private_ips=[],
-                              driver=self,
-                              size=size,
-                              image=image,
-                              extra=extra)
+        nodes = []
+        for node_id in ids:
+            nodes.append(StratusLabNode(node_id=node_id,
+                                        name=name,
+                                        state=NodeState.PENDING,
+                                        public_ips=[],
+                                        private_ips=[],
+                                        driver=self,
+                                        size=size,
+                                        image=image,
+                                        extra={'location': location}))
 
         try:
-            _, ip = runner.getNetworkDetail(node_id)
-            node.public_ips = [ip]
-
-        except Exception as e:
-            print e
+            self.ex_get_nodes_details(nodes)
+        except Exception:
+            # the nodes exist; only their details are missing
+            _log.exception('cannot get the details of the created nodes')
 
-        return node
+        return nodes
 
-    def _create_runner(self, name, size, image, location=None, auth=None):
+    def _create_runner(self, name, size, image, location=None, auth=None,
+                       count=1):
 
         location = location or self.default_location
 
@@ -481,6 +1579,7 @@ class StratusLabNodeDriver(NodeDriver):
         self._insert_required_run_option_defaults(holder)
 
         holder.set('vmName', name)
+        holder.set('instanceNumber', count)
 
         pubkey_file = None
         if isinstance(auth, NodeAuthSSHKey):
@@ -528,14 +1627,59 @@ class StratusLabNodeDriver(NodeDriver):
 
         """
 
-        runner = self._create_runner(node.name, node.size, node.image,
-                                     location=node.location)
-        runner.killInstances([node.id])
+        return self.ex_destroy_nodes([node])
+
+    def ex_destroy_nodes(self, nodes):
+        """
+        Terminates all of the given nodes.  The nodes are grouped by
+        location and a single kill request is made for each location.
+
+        All of the locations are tried even if some of them fail; the
+        nodes in the successful locations are marked as terminated.
+        The first error encountered is then raised.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+
+        groups = {}
+        for node in nodes:
+            location = getattr(node, 'location', None) or self.default_location
+            groups.setdefault(location.id, (location, []))[1].append(node)
+
+        first_error = None
+        for location, location_nodes in groups.values():
+            try:
+                runner = self._create_kill_runner(location, location_nodes[0].image)
+                with self._timer('killInstances', location):
+                    runner.killInstances([node.id for node in location_nodes])
+            except Exception as e:
+                if first_error is None:
+                    first_error = e
+                continue
+
+            for node in location_nodes:
+                node.state = NodeState.TERMINATED
 
-        node.state = NodeState.TERMINATED
+        if first_error is not None:
+            raise first_error
 
         return True
 
+    def _create_kill_runner(self, location, image=None):
+        """
+        Creates a Runner that is only used to terminate machines.  The
+        Runner is the client library entry point for killing
+        instances, but unlike _create_runner, none of the options for
+        launching a machine (name, resources, ssh key) are set.
+
+        """
+        holder = self._get_config_section(location)
+        self._insert_required_run_option_defaults(holder)
+
+        image_id = getattr(image, 'id', None)
+        return Runner(image_id, holder)
+
     def list_images(self, location=None):
         """
         Returns a list of images from the StratusLab Marketplace.  The
@@ -550,38 +1694,226 @@ class StratusLabNodeDriver(NodeDriver):
         @inherits: L{NodeDriver.list_images}
         """
 
-        location = location or self.default_location
+        images = []
+        try:
+            images = self._list_catalog(location)
+        except Exception:
+            _log.exception('cannot list the images of the marketplace')
 
-        holder = self._get_config_section(location)
-        url = holder.config.get('marketplaceEndpoint',
-                                self.DEFAULT_MARKETPLACE_URL)
-        endpoint = '%s/metadata' % url
-        return self._get_marketplace_images(endpoint)
+        return images
+
+    def ex_iter_images(self, location=None):
+        """
+        Generator that yields the images from the StratusLab
+        Marketplace one at a time as the metadata is read.  Neither
+        the metadata document nor the images are kept, so memory use
+        does not grow with the size of the Marketplace; the image
+        catalog used by get_image and ex_find_images is only built by
+        list_images and ex_find_images.  Unlike list_images, errors
+        are raised to the caller.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+        url = self._marketplace_url(location)
+        return self._iter_marketplace_images('%s/metadata' % url)
 
-    def _get_marketplace_images(self, url):
+    def _list_catalog(self, location=None):
+        """
+        Lists the images of the Marketplace into a new, complete image
+        catalog that replaces the previous one (and is recorded in the
+        registry, if any).  Returns the list of images in the order of
+        the Marketplace metadata.
+        """
+        url = self._marketplace_url(location)
+
+        catalog = ImageCatalog()
         images = []
+        for image in self._iter_marketplace_images('%s/metadata' % url):
+            self._add_to_catalog(catalog, image)
+            images.append(image)
+
+        catalog.complete = True
+        self._image_catalogs[url] = catalog
+
+        if self.registry is not None:
+            self._record_images(url, catalog)
+
+        return images
+
+    def get_image(self, image_id, location=None):
+        """
+        Returns the image with the given Marketplace identifier.  The
+        image catalog built by the last listing of the images is
+        consulted first.  If the image is not there, only the
+        metadata for that identifier is requested from the
+        Marketplace; the full metadata is never downloaded.
+
+        Raises an exception if the image cannot be found.
+        """
+        url = self._marketplace_url(location)
+
+        catalog = self._image_catalogs.get(url)
+        if catalog is None:
+            catalog = self._image_catalogs.setdefault(url, ImageCatalog())
+
+        image = catalog.get(image_id)
+        if image is not None:
+            return image
+
+        endpoint = '%s/metadata/%s' % (url, urllib.quote(image_id, safe=''))
         try:
-            filename, _ = urllib.urlretrieve(url)
-            tree = ET.parse(filename)
-            root = tree.getroot()
-            for md in root.findall(self.RDF_RDF):
-                rdf_desc = md.find(self.RDF_DESCRIPTION)
-                image_id = rdf_desc.find(self.DC_IDENTIFIER).text
-                elem = rdf_desc.find(self.DC_TITLE)
-                if elem is None or len(elem) == 0:
-                    elem = rdf_desc.find(self.DC_DESCRIPTION)
-
-                if elem is not None and elem.text is not None:
-                    name = elem.text.lstrip()[:30]
-                else:
-                    name = ''
-                images.append(NodeImage(id=image_id, name=name, driver=self))
-        except Exception as e:
-            # TODO: log errors instead of ignoring them
-            print e
+            for image in self._iter_marketplace_images(endpoint):
+                if image.id == image_id:
+                    return self._add_to_catalog(catalog, image)
+        except urllib2.HTTPError as e:
+            if e.code != 404:
+                raise
+
+        raise Exception('image for %s cannot be found' % image_id)
+
+    def ex_find_images(self, title=None, description_prefix=None,
+                       location=None):
+        """
+        Returns the list of images with the given title and/or with
+        a description starting with the given prefix.  The image
+        catalog is used; the images are listed first if the catalog
+        is not complete.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+        url = self._marketplace_url(location)
+
+        catalog = self._image_catalogs.get(url)
+        if catalog is None or not catalog.complete:
+            self._list_catalog(location)
+            catalog = self._image_catalogs[url]
+
+        if title is not None:
+            images = catalog.find_by_title(title)
+        else:
+            images = catalog.images()
+
+        if description_prefix is not None:
+            matching_ids = set([image.id for image in
+                                catalog.find_by_description_prefix(description_prefix)])
+            images = [image for image in images if image.id in matching_ids]
 
         return images
 
+    def _record_images(self, url, catalog):
+        rows = []
+        for image in catalog.images():
+            rows.append({'image_id': image.id,
+                         'name': image.name,
+                         'title': image.extra.get('title'),
+                         'description': image.extra.get('description')})
+        try:
+            self.registry.save_images(url, rows)
+        except Exception:
+            _log.exception('cannot record the images of %s', url)
+
+    @staticmethod
+    def _add_to_catalog(catalog, image):
+        return catalog.add(image,
+                           title=image.extra.get('title'),
+                           description=image.extra.get('description'))
+
+    def _marketplace_url(self, location=None):
+        location = location or self.default_location
+
+        holder = self._get_config_section(location)
+        return holder.config.get('marketplaceEndpoint',
+                                 self.DEFAULT_MARKETPLACE_URL)
+
+    def _iter_marketplace_images(self, url):
+        """
+        Parses the Marketplace metadata incrementally, yielding an
+        image for each RDF entry that is a direct child of the root
+        element.  Each entry is removed from the tree once it has
+        been processed, so memory use does not grow with the size of
+        the metadata.
+
+        """
+        stream = self._open_marketplace_url(url)
+        try:
+            root = None
+            depth = 0
+            for event, elem in ET.iterparse(stream, events=('start', 'end')):
+                if event == 'start':
+                    if root is None:
+                        root = elem
+                    depth += 1
+                    continue
+
+                depth -= 1
+                if depth == 1 and elem.tag == self.RDF_RDF:
+                    image = self._rdf_to_image(elem)
+                    root.clear()
+                    if image is not None:
+                        yield image
+        finally:
+            stream.close()
+
+    def _rdf_to_image(self, md):
+        rdf_desc = md.find(self.RDF_DESCRIPTION)
+        if rdf_desc is None:
+            return None
+
+        identifier = rdf_desc.find(self.DC_IDENTIFIER)
+        if identifier is None:
+            return None
+        image_id = identifier.text
+
+        title = rdf_desc.find(self.DC_TITLE)
+        description = rdf_desc.find(self.DC_DESCRIPTION)
+
+        elem = title
+        if elem is None or len(elem) == 0:
+            elem = description
+
+        if elem is not None and elem.text is not None:
+            name = elem.text.lstrip()[:30]
+        else:
+            name = ''
+
+        extra = {'title': self._element_text(title),
+                 'description': self._element_text(description)}
+
+        return NodeImage(id=image_id, name=name, driver=self, extra=extra)
+
+    @staticmethod
+    def _element_text(elem):
+        if elem is not None and elem.text is not None:
+            return elem.text.strip()
+        else:
+            return None
+
+    def _open_marketplace_url(self, url):
+        """
+        Returns a file-like object with the contents of the given
+        Marketplace URL, using the on-disk cache if it is enabled.
+        The 'marketplace' timer covers the whole download: it ends
+        when the object is closed, and fails if opening or reading
+        the URL raised an exception.
+
+        """
+        timer = self.metrics.timer('marketplace', urlparse.urlparse(url).netloc)
+        timer.__enter__()
+        try:
+            stream = self._fetch_marketplace_url(url)
+        except:
+            timer.__exit__(*sys.exc_info())
+            raise
+        return _TimedStream(stream, timer)
+
+    def _fetch_marketplace_url(self, url):
+        if self.marketplace_cache is not None:
+            return self.marketplace_cache.open(url)
+        else:
+            return urllib2.urlopen(url)
+
     def list_sizes(self, location=None):
         """
         StratusLab node sizes are defined by the client and do not
@@ -619,12 +1951,10 @@ class StratusLabNodeDriver(NodeDriver):
         interface.
         """
 
-        configHolder = self._get_config_section(location)
-
-        pdisk = PersistentDisk(configHolder)
-
         filters = {}
-        volumes = pdisk.describeVolumes(filters)
+        with self._pdisk(location) as pdisk:
+            with self._timer('describeVolumes', location):
+                volumes = pdisk.describeVolumes(filters)
 
         storage_volumes = []
         for info in volumes:
@@ -654,12 +1984,10 @@ class StratusLabNodeDriver(NodeDriver):
 
         @inherits: L{NodeDriver.create_volume}
         """
-        configHolder = self._get_config_section(location)
-
-        pdisk = PersistentDisk(configHolder)
-
         # Creates a private disk.  Boolean flag = False means private.
-        vol_uuid = pdisk.createVolume(size, name, False)
+        with self._pdisk(location) as pdisk:
+            with self._timer('createVolume', location):
+                vol_uuid = pdisk.createVolume(size, name, False)
 
         extra = {'location': location}
 
@@ -674,25 +2002,23 @@ class StratusLabNodeDriver(NodeDriver):
 
         location = self._volume_location(volume)
 
-        configHolder = self._get_config_section(location)
-        pdisk = PersistentDisk(configHolder)
-
-        pdisk.deleteVolume(volume.id)
+        with self._pdisk(location) as pdisk:
+            with self._timer('deleteVolume', location):
+                pdisk.deleteVolume(volume.id)
 
         return True
 
     def attach_volume(self, node, volume, device=None):
         location = self._volume_location(volume)
 
-        configHolder = self._get_config_section(location)
-        pdisk = PersistentDisk(configHolder)
-
         try:
             host = node.host
         except AttributeError:
             raise Exception('node does not contain host information')
 
-        pdisk.hotAttach(host, node.id, volume.id)
+        with self._pdisk(location) as pdisk:
+            with self._timer('hotAttach', location):
+                pdisk.hotAttach(host, node.id, volume.id)
 
         try:
             volume.extra['node'] = node
@@ -705,15 +2031,14 @@ class StratusLabNodeDriver(NodeDriver):
 
         location = self._volume_location(volume)
 
-        configHolder = self._get_config_section(location)
-        pdisk = PersistentDisk(configHolder)
-
         try:
             node = volume.extra['node']
         except (AttributeError, KeyError):
             raise Exception('volume is not attached to a node')
 
-        pdisk.hotDetach(node.id, volume.id)
+        with self._pdisk(location) as pdisk:
+            with self._timer('hotDetach', location):
+                pdisk.hotDetach(node.id, volume.id)
 
         del(volume.extra['node'])
 
@@ -0,0 +1,115 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+In-memory index of the images available in a StratusLab Marketplace.
+"""
+
+import bisect
+import threading
+
+
+class ImageCatalog(object):
+    """
+    Index of Marketplace images.  The primary index is on the
+    Marketplace identifier (dc:identifier); secondary indexes allow
+    the images to be found by title and by a prefix of their
+    description.
+
+    When the Marketplace contains several entries for the same
+    identifier, the first one added is kept, as a linear scan of the
+    image list would have done.
+
+    The catalog is 'complete' once it contains all of the images of
+    the Marketplace; until then, a missing identifier does not mean
+    that the image does not exist.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_id = {}
+        self._by_title = {}
+        self._descriptions = []
+        self._descriptions_sorted = True
+        self.complete = False
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, image_id):
+        return image_id in self._by_id
+
+    def add(self, image, title=None, description=None):
+        """
+        Adds the image to the catalog.  Returns the indexed image,
+        which is the previously indexed one if the identifier is
+        already present.
+        """
+        with self._lock:
+            try:
+                return self._by_id[image.id]
+            except KeyError:
+                pass
+
+            self._by_id[image.id] = image
+
+            if title:
+                self._by_title.setdefault(title, []).append(image)
+
+            if description:
+                self._descriptions.append((description, image.id))
+                self._descriptions_sorted = False
+
+            return image
+
+    def get(self, image_id):
+        """
+        Returns the image with the given identifier or None if it is
+        not in the catalog.
+        """
+        return self._by_id.get(image_id)
+
+    def images(self):
+        """
+        Returns a list of all of the images in the catalog.
+        """
+        return self._by_id.values()
+
+    def find_by_title(self, title):
+        """
+        Returns the list of images with exactly the given title.
+        """
+        return list(self._by_title.get(title, []))
+
+    def find_by_description_prefix(self, prefix):
+        """
+        Returns the list of images with a description starting with
+        the given prefix, in description order.
+        """
+        with self._lock:
+            if not self._descriptions_sorted:
+                self._descriptions.sort()
+                self._descriptions_sorted = True
+
+            images = []
+            i = bisect.bisect_left(self._descriptions, (prefix,))
+            while i < len(self._descriptions):
+                description, image_id = self._descriptions[i]
+                if not description.startswith(prefix):
+                    break
+                images.append(self._by_id[image_id])
+                i += 1
+
+            return images
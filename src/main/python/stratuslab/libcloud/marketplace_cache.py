@@ -0,0 +1,212 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+On-disk cache for documents retrieved from the StratusLab Marketplace.
+"""
+#
+# The cache is a directory containing two files for each cached URL:
+# the document itself and a small JSON file with the validators
+# (ETag, Last-Modified) and the time of the last successful check.
+# Both files are named after the SHA-1 hash of the URL.  Files are
+# written to temporary files and then renamed, so the directory can
+# be shared safely between driver instances and processes.
+#
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+import urllib2
+
+
+class MarketplaceCache(object):
+    """
+    Retrieves documents over HTTP(S), keeping a copy on disk.  A
+    cached copy younger than max_age seconds is used without
+    contacting the server.  Older copies are revalidated with a
+    conditional GET (If-None-Match/If-Modified-Since).  If the server
+    cannot be contacted, an existing copy is used regardless of its
+    age.
+    """
+
+    DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'),
+                                     '.stratuslab', 'cache', 'marketplace')
+
+    DEFAULT_MAX_AGE = 300
+
+    def __init__(self, cache_dir=None, max_age=DEFAULT_MAX_AGE):
+        self.cache_dir = cache_dir or self.DEFAULT_CACHE_DIR
+        self.max_age = max_age
+
+    def open(self, url):
+        """
+        Returns a file-like object with the contents of the document
+        at the given URL.  If the document must be downloaded, the
+        returned object reads directly from the server response and
+        the cache is updated once the document has been read to the
+        end.  The caller is responsible for closing the object.
+        """
+
+        body_path, meta_path = self._paths(url)
+        meta = self._read_meta(meta_path)
+
+        if meta is not None and not os.path.exists(body_path):
+            meta = None
+
+        if meta is not None:
+            age = time.time() - meta.get('checked', 0)
+            if age < self.max_age:
+                return open(body_path, 'rb')
+
+        request = urllib2.Request(url)
+        if meta is not None:
+            if meta.get('etag'):
+                request.add_header('If-None-Match', meta['etag'])
+            if meta.get('last_modified'):
+                request.add_header('If-Modified-Since', meta['last_modified'])
+
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            if e.code == 304 and meta is not None:
+                meta['checked'] = time.time()
+                self._write_meta(meta_path, meta)
+                return open(body_path, 'rb')
+            raise
+        except urllib2.URLError:
+            if meta is not None:
+                return open(body_path, 'rb')
+            raise
+
+        headers = response.info()
+        new_meta = {'url': url,
+                    'etag': headers.getheader('ETag'),
+                    'last_modified': headers.getheader('Last-Modified'),
+                    'checked': time.time()}
+
+        return _CachingReader(self, response, body_path, meta_path, new_meta)
+
+    def invalidate(self, url):
+        """
+        Removes any cached copy of the document at the given URL.
+        """
+        for path in self._paths(url):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _paths(self, url):
+        key = hashlib.sha1(url).hexdigest()
+        base = os.path.join(self.cache_dir, key)
+        return base + '.data', base + '.json'
+
+    @staticmethod
+    def _read_meta(meta_path):
+        try:
+            with open(meta_path, 'rb') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write_meta(self, meta_path, meta):
+        try:
+            fd, tmp_path = self._mkstemp()
+            with os.fdopen(fd, 'wb') as f:
+                json.dump(meta, f)
+            self._replace(tmp_path, meta_path)
+        except (IOError, OSError):
+            pass
+
+    def _mkstemp(self):
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # may have been created concurrently by another process
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        return tempfile.mkstemp(prefix='.tmp', dir=self.cache_dir)
+
+    @staticmethod
+    def _replace(src, dst):
+        try:
+            os.rename(src, dst)
+        except OSError:
+            # rename does not overwrite existing files on Windows
+            os.remove(dst)
+            os.rename(src, dst)
+
+
+class _CachingReader(object):
+    """
+    File-like wrapper around an HTTP response that copies everything
+    read into a temporary file in the cache directory.  When the end
+    of the response is reached, the copy becomes the cached document.
+    If the cache directory cannot be written, the response is still
+    readable; it is just not cached.
+    """
+
+    def __init__(self, cache, response, body_path, meta_path, meta):
+        self._cache = cache
+        self._response = response
+        self._body_path = body_path
+        self._meta_path = meta_path
+        self._meta = meta
+
+        try:
+            fd, self._tmp_path = cache._mkstemp()
+            self._tmp = os.fdopen(fd, 'wb')
+        except (IOError, OSError):
+            self._tmp_path = None
+            self._tmp = None
+
+    def read(self, size=-1):
+        data = self._response.read(size)
+
+        if self._tmp is not None:
+            try:
+                if data:
+                    self._tmp.write(data)
+                if (data and size < 0) or (not data and size != 0):
+                    self._commit()
+            except (IOError, OSError):
+                self._discard()
+
+        return data
+
+    def close(self):
+        self._discard()
+        self._response.close()
+
+    def _commit(self):
+        self._tmp.close()
+        self._tmp = None
+        self._cache._replace(self._tmp_path, self._body_path)
+        self._tmp_path = None
+        self._cache._write_meta(self._meta_path, self._meta)
+
+    def _discard(self):
+        if self._tmp is not None:
+            self._tmp.close()
+            self._tmp = None
+        if self._tmp_path is not None:
+            try:
+                os.remove(self._tmp_path)
+            except OSError:
+                pass
+            self._tmp_path = None
@@ -0,0 +1,193 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Latency and error metrics for the operations of the StratusLab driver.
+"""
+#
+# A metrics backend is any object with a timer(operation, location)
+# method returning a context manager; the driver wraps each call to a
+# StratusLab service in such a timer.  NullMetrics is used when no
+# backend is configured and costs one method call per operation.
+# HistogramMetrics keeps cumulative histograms in memory and exports
+# them in the Prometheus text format.
+#
+
+import bisect
+import threading
+import time
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class NullMetrics(object):
+    """
+    Metrics backend that records nothing.
+    """
+
+    _TIMER = _NullTimer()
+
+    def timer(self, operation, location):
+        return self._TIMER
+
+
+class _Timer(object):
+
+    __slots__ = ('metrics', 'operation', 'location', 'start')
+
+    def __init__(self, metrics, operation, location):
+        self.metrics = metrics
+        self.operation = operation
+        self.location = location
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.operation, self.location,
+                             time.time() - self.start,
+                             error=exc_type is not None)
+        return False
+
+
+class _Histogram(object):
+
+    __slots__ = ('counts', 'count', 'sum', 'errors')
+
+    def __init__(self, n_buckets):
+        # the last count is for the values above the largest bound
+        self.counts = [0] * (n_buckets + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+
+
+class HistogramMetrics(object):
+    """
+    In-process metrics backend.  For each operation and location, a
+    histogram of the durations (in seconds) is kept along with the
+    number of calls, their total duration and the number of calls
+    that raised an exception.
+    """
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                       1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix='stratuslab'):
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def timer(self, operation, location):
+        """
+        Returns a context manager that records the duration of the
+        enclosed block (and whether it raised an exception).
+        """
+        return _Timer(self, operation, location)
+
+    def observe(self, operation, location, seconds, error=False):
+        """
+        Records one call of the operation that took the given number
+        of seconds.
+        """
+        i = bisect.bisect_left(self.buckets, seconds)
+        key = (operation, location)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = _Histogram(len(self.buckets))
+                self._histograms[key] = histogram
+            histogram.counts[i] += 1
+            histogram.count += 1
+            histogram.sum += seconds
+            if error:
+                histogram.errors += 1
+
+    def reset(self):
+        """
+        Discards all of the recorded values.
+        """
+        with self._lock:
+            self._histograms = {}
+
+    def snapshot(self):
+        """
+        Returns a dictionary keyed by (operation, location) tuples
+        whose values are dictionaries with the 'count', 'sum',
+        'errors' and (cumulative) 'buckets' of the histogram.  The
+        buckets are a list of (upper bound, count) tuples ending with
+        an infinite bound.
+        """
+        with self._lock:
+            result = {}
+            for key, histogram in self._histograms.items():
+                buckets = []
+                total = 0
+                bounds = self.buckets + (float('inf'),)
+                for bound, count in zip(bounds, histogram.counts):
+                    total += count
+                    buckets.append((bound, total))
+                result[key] = {'count': histogram.count,
+                               'sum': histogram.sum,
+                               'errors': histogram.errors,
+                               'buckets': buckets}
+            return result
+
+    def to_prometheus(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        duration = '%s_operation_duration_seconds' % self.prefix
+        errors = '%s_operation_errors_total' % self.prefix
+
+        lines = ['# HELP %s Duration of the StratusLab service calls.' % duration,
+                 '# TYPE %s histogram' % duration]
+        error_lines = ['# HELP %s Number of failed StratusLab service calls.' % errors,
+                       '# TYPE %s counter' % errors]
+
+        snapshot = self.snapshot()
+        for key in sorted(snapshot.keys()):
+            values = snapshot[key]
+            labels = 'operation="%s",location="%s"' % (_escape(key[0]),
+                                                       _escape(key[1]))
+            for bound, count in values['buckets']:
+                lines.append('%s_bucket{%s,le="%s"} %d' %
+                             (duration, labels, _format_bound(bound), count))
+            lines.append('%s_sum{%s} %r' % (duration, labels, values['sum']))
+            lines.append('%s_count{%s} %d' % (duration, labels, values['count']))
+            error_lines.append('%s{%s} %d' % (errors, labels, values['errors']))
+
+        return '\n'.join(lines + error_lines) + '\n'
+
+
+def _format_bound(bound):
+    if bound == float('inf'):
+        return '+Inf'
+    return repr(bound)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
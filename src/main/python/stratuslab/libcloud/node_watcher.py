@@ -0,0 +1,271 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Notification of node state and IP address changes, with a single
+background poller per location shared by all of the watchers.
+"""
+
+import logging
+import threading
+
+_log = logging.getLogger(__name__)
+
+
+def diff_snapshots(old, new):
+    """
+    Compares two snapshots (dictionaries keyed by node id) and
+    returns a tuple of the sets of added, removed and changed ids.
+    """
+    old_ids = set(old.keys())
+    new_ids = set(new.keys())
+
+    changed = set()
+    for node_id in old_ids.intersection(new_ids):
+        if old[node_id] != new[node_id]:
+            changed.add(node_id)
+
+    return new_ids - old_ids, old_ids - new_ids, changed
+
+
+class NodeEvent(object):
+    """
+    Change of a watched node.  For ADDED and REMOVED events, old and
+    new are (state, public_ip) tuples or None; for STATE and IP events
+    they are the previous and current state or IP address.
+    """
+
+    ADDED = 'added'
+    REMOVED = 'removed'
+    STATE = 'state'
+    IP = 'ip'
+
+    __slots__ = ('kind', 'node_id', 'location_id', 'old', 'new')
+
+    def __init__(self, kind, node_id, location_id, old, new):
+        self.kind = kind
+        self.node_id = node_id
+        self.location_id = location_id
+        self.old = old
+        self.new = new
+
+    def __repr__(self):
+        return ('<NodeEvent: kind=%s, node_id=%s, location=%s, old=%s, new=%s>' %
+                (self.kind, self.node_id, self.location_id, self.old, self.new))
+
+
+class Subscription(object):
+    """
+    Registration of a watcher for a location, either for all of its
+    nodes or only for the given node ids.  Events are passed to the
+    callback (called from the poller thread) and/or put on the queue.
+
+    The first poll after subscribing produces an ADDED event for each
+    matching node, so that watchers learn the current state.
+    """
+
+    def __init__(self, watcher, location, node_ids=None, callback=None,
+                 queue=None):
+        self.watcher = watcher
+        self.location = location
+        if node_ids is None:
+            self.node_ids = None
+        else:
+            self.node_ids = frozenset(node_ids)
+        self.callback = callback
+        self.queue = queue
+        self.primed = False
+
+    def accepts(self, node_id):
+        return self.node_ids is None or node_id in self.node_ids
+
+    def cancel(self):
+        self.watcher.unsubscribe(self)
+
+    def notify(self, event):
+        if self.callback is not None:
+            try:
+                self.callback(event)
+            except Exception:
+                # a failing watcher must not stop the poller
+                _log.exception('node watcher callback failed for %s', event)
+        if self.queue is not None:
+            self.queue.put(event)
+
+
+class _LocationPoller(object):
+    """
+    Background thread polling one location and notifying the
+    subscriptions of the differences between successive snapshots.
+    """
+
+    def __init__(self, location, fetch, interval):
+        self.location = location
+        self.fetch = fetch
+        self.interval = interval
+
+        self.subscriptions = []
+        self.snapshot = None
+        self.last_error = None
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='node-watcher-%s' % location.id)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def add(self, subscription):
+        with self._lock:
+            self.subscriptions.append(subscription)
+
+    def remove(self, subscription):
+        with self._lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+            return len(self.subscriptions)
+
+    def _run(self):
+        while not self._stop.isSet():
+            self.poll()
+            self._stop.wait(self.interval)
+
+    def poll(self):
+        try:
+            snapshot = self.fetch(self.location)
+        except Exception as e:
+            self.last_error = e
+            return
+        self.last_error = None
+
+        previous = self.snapshot
+        self.snapshot = snapshot
+
+        with self._lock:
+            subscriptions = list(self.subscriptions)
+
+        events = []
+        if previous is not None:
+            events = self._diff_events(previous, snapshot)
+
+        location_id = self.location.id
+        for subscription in subscriptions:
+            if not subscription.primed:
+                subscription.primed = True
+                for node_id, value in snapshot.items():
+                    if subscription.accepts(node_id):
+                        subscription.notify(NodeEvent(NodeEvent.ADDED, node_id,
+                                                      location_id, None, value))
+                continue
+
+            for event in events:
+                if subscription.accepts(event.node_id):
+                    subscription.notify(event)
+
+    def _diff_events(self, previous, snapshot):
+        location_id = self.location.id
+        added, removed, changed = diff_snapshots(previous, snapshot)
+
+        events = []
+        for node_id in added:
+            events.append(NodeEvent(NodeEvent.ADDED, node_id, location_id,
+                                    None, snapshot[node_id]))
+        for node_id in removed:
+            events.append(NodeEvent(NodeEvent.REMOVED, node_id, location_id,
+                                    previous[node_id], None))
+        for node_id in changed:
+            old_state, old_ip = previous[node_id]
+            new_state, new_ip = snapshot[node_id]
+            if old_state != new_state:
+                events.append(NodeEvent(NodeEvent.STATE, node_id, location_id,
+                                        old_state, new_state))
+            if old_ip != new_ip:
+                events.append(NodeEvent(NodeEvent.IP, node_id, location_id,
+                                        old_ip, new_ip))
+        return events
+
+
+class NodeWatcher(object):
+    """
+    Manages one poller per watched location.  The fetch function
+    takes a location and returns a dictionary mapping node ids to
+    (state, public_ip) tuples.  A poller is started with the first
+    subscription for its location and stopped when the last one is
+    cancelled, so N watchers of a location cost one poll per interval.
+    """
+
+    DEFAULT_INTERVAL = 10
+
+    def __init__(self, fetch, interval=DEFAULT_INTERVAL):
+        self.fetch = fetch
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._pollers = {}
+
+    def subscribe(self, location, node_ids=None, callback=None, queue=None):
+        """
+        Registers a watcher for the nodes of the given location (all
+        of them if node_ids is None) and returns the Subscription.
+        """
+        subscription = Subscription(self, location, node_ids=node_ids,
+                                    callback=callback, queue=queue)
+        with self._lock:
+            poller = self._pollers.get(location.id)
+            if poller is None:
+                poller = _LocationPoller(location, self.fetch, self.interval)
+                self._pollers[location.id] = poller
+                poller.add(subscription)
+                poller.start()
+            else:
+                poller.add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Cancels the subscription, stopping the poller of its location
+        if it was the last one.
+        """
+        location_id = subscription.location.id
+        with self._lock:
+            poller = self._pollers.get(location_id)
+            if poller is not None and poller.remove(subscription) == 0:
+                poller.stop()
+                del self._pollers[location_id]
+
+    def stop(self):
+        """
+        Stops all of the pollers and drops all of the subscriptions.
+        """
+        with self._lock:
+            for poller in self._pollers.values():
+                poller.stop()
+            self._pollers = {}
+
+    def last_error(self, location):
+        """
+        Returns the exception raised by the last poll of the location
+        or None if it succeeded (or the location is not watched).
+        """
+        poller = self._pollers.get(location.id)
+        if poller is not None:
+            return poller.last_error
+        return None
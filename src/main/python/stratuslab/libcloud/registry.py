@@ -0,0 +1,188 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Local SQLite registry of the last known nodes and Marketplace images.
+"""
+#
+# A new connection is opened for each operation, so a registry can be
+# used from several threads and shared between processes; SQLite
+# serializes the writers.  The nodes of a location (and the images of
+# a Marketplace) are always replaced as a whole, in one transaction.
+#
+
+import sqlite3
+import time
+
+from contextlib import closing
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS locations (
+    location_id TEXT PRIMARY KEY,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    location_id TEXT NOT NULL,
+    node_id TEXT NOT NULL,
+    name TEXT,
+    state INTEGER,
+    public_ip TEXT,
+    cpu TEXT,
+    ram TEXT,
+    disk TEXT,
+    image_id TEXT,
+    PRIMARY KEY (location_id, node_id)
+);
+CREATE TABLE IF NOT EXISTS images (
+    url TEXT NOT NULL,
+    image_id TEXT NOT NULL,
+    name TEXT,
+    title TEXT,
+    description TEXT,
+    PRIMARY KEY (url, image_id)
+);
+"""
+
+NODE_FIELDS = ('node_id', 'name', 'state', 'public_ip',
+               'cpu', 'ram', 'disk', 'image_id')
+
+IMAGE_FIELDS = ('image_id', 'name', 'title', 'description')
+
+
+class NodeRegistry(object):
+    """
+    Persistent store of the nodes of each location and of the
+    images of each Marketplace.  Nodes and images are passed as
+    dictionaries with the keys in NODE_FIELDS and IMAGE_FIELDS.
+    """
+
+    DEFAULT_TIMEOUT = 10
+
+    def __init__(self, path, timeout=DEFAULT_TIMEOUT):
+        """
+        :param path: name of the SQLite database file, created if
+        it does not exist
+        :param timeout: seconds to wait for a lock held by another
+        connection
+        """
+        self.path = path
+        self.timeout = timeout
+
+        with closing(self._connect()) as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=self.timeout)
+
+    def save_nodes(self, location_id, nodes):
+        """
+        Replaces the nodes recorded for the location.
+        """
+        rows = []
+        for node in nodes:
+            rows.append((location_id,) +
+                        tuple([node.get(field) for field in NODE_FIELDS]))
+
+        with closing(self._connect()) as conn:
+            with conn:
+                conn.execute('DELETE FROM nodes WHERE location_id = ?',
+                             (location_id,))
+                conn.executemany('INSERT OR REPLACE INTO nodes '
+                                 '(location_id, %s) VALUES (?, %s)' %
+                                 (', '.join(NODE_FIELDS),
+                                  ', '.join(['?'] * len(NODE_FIELDS))),
+                                 rows)
+                conn.execute('INSERT OR REPLACE INTO locations '
+                             '(location_id, updated) VALUES (?, ?)',
+                             (location_id, time.time()))
+
+    def load_nodes(self, location_id=None):
+        """
+        Returns a dictionary mapping the location ids to the lists of
+        recorded nodes, for all locations or only the given one.
+        Locations that have been saved without nodes map to an empty
+        list.
+        """
+        with closing(self._connect()) as conn:
+            if location_id is None:
+                locations = conn.execute('SELECT location_id '
+                                         'FROM locations').fetchall()
+                rows = conn.execute('SELECT location_id, %s FROM nodes '
+                                    'ORDER BY location_id, node_id' %
+                                    ', '.join(NODE_FIELDS)).fetchall()
+            else:
+                locations = conn.execute('SELECT location_id FROM locations '
+                                         'WHERE location_id = ?',
+                                         (location_id,)).fetchall()
+                rows = conn.execute('SELECT location_id, %s FROM nodes '
+                                    'WHERE location_id = ? ORDER BY node_id' %
+                                    ', '.join(NODE_FIELDS),
+                                    (location_id,)).fetchall()
+
+            nodes = {}
+            for (loc_id,) in locations:
+                nodes[loc_id] = []
+            for row in rows:
+                nodes.setdefault(row[0], []).append(dict(zip(NODE_FIELDS,
+                                                             row[1:])))
+            return nodes
+
+    def updated(self, location_id):
+        """
+        Returns the time at which the nodes of the location were last
+        saved or None if they never were.
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT updated FROM locations '
+                               'WHERE location_id = ?',
+                               (location_id,)).fetchone()
+            if row is None:
+                return None
+            return row[0]
+
+    def save_images(self, url, images):
+        """
+        Replaces the images recorded for the Marketplace at the URL.
+        """
+        rows = []
+        for image in images:
+            rows.append((url,) +
+                        tuple([image.get(field) for field in IMAGE_FIELDS]))
+
+        with closing(self._connect()) as conn:
+            with conn:
+                conn.execute('DELETE FROM images WHERE url = ?', (url,))
+                conn.executemany('INSERT OR IGNORE INTO images '
+                                 '(url, %s) VALUES (?, %s)' %
+                                 (', '.join(IMAGE_FIELDS),
+                                  ', '.join(['?'] * len(IMAGE_FIELDS))),
+                                 rows)
+
+    def load_images(self):
+        """
+        Returns a dictionary mapping the Marketplace URLs to the lists
+        of recorded images.
+        """
+        with closing(self._connect()) as conn:
+            rows = conn.execute('SELECT url, %s FROM images '
+                                'ORDER BY url, rowid' %
+                                ', '.join(IMAGE_FIELDS)).fetchall()
+
+            images = {}
+            for row in rows:
+                images.setdefault(row[0], []).append(dict(zip(IMAGE_FIELDS,
+                                                              row[1:])))
+            return images
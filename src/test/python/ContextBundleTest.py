@@ -0,0 +1,105 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import unittest
+
+from StringIO import StringIO
+
+from stratuslab.dirac.context_bundle import ContextBundle, get_bundle
+
+
+class ContextBundleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.files = []
+        for name, content in (('cert.pem', 'certificate'),
+                              ('key.pem', 'private key'),
+                              ('context.bash', '#!/bin/bash\n')):
+            path = os.path.join(self.tmp_dir, name)
+            with open(path, 'w') as f:
+                f.write(content)
+            self.files.append((path, '/root/%s' % name))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @staticmethod
+    def _members(data):
+        tar = tarfile.open(fileobj=StringIO(data), mode='r:gz')
+        try:
+            return dict([(m.name, tar.extractfile(m).read()) for m in tar.getmembers()])
+        finally:
+            tar.close()
+
+    def test_archive_contains_all_files(self):
+        bundle = ContextBundle(self.files)
+        members = self._members(bundle.archive())
+        self.assertEqual(members, {'root/cert.pem': 'certificate',
+                                   'root/key.pem': 'private key',
+                                   'root/context.bash': '#!/bin/bash\n'})
+
+    def test_archive_is_built_once(self):
+        bundle = ContextBundle(self.files)
+        self.assertTrue(bundle.archive() is bundle.archive(list(self.files)))
+
+    def test_matching_files_are_skipped(self):
+        bundle = ContextBundle(self.files)
+        output = '%s  /root/cert.pem\n%s */root/key.pem\n' % (
+            hashlib.sha256('certificate').hexdigest(),
+            hashlib.sha256('old key').hexdigest())
+
+        needed = bundle.needed(bundle.parse_checksums(output))
+        self.assertEqual([remote for _, remote in needed],
+                         ['/root/key.pem', '/root/context.bash'])
+        self.assertEqual(sorted(self._members(bundle.archive(needed)).keys()),
+                         ['root/context.bash', 'root/key.pem'])
+
+        self.assertEqual(bundle.needed({}), list(self.files))
+
+    def test_commands(self):
+        bundle = ContextBundle(self.files)
+        self.assertEqual(bundle.checksum_command(),
+                         'sha256sum /root/cert.pem /root/key.pem /root/context.bash 2>/dev/null')
+        self.assertEqual(ContextBundle.extract_command('/root/a.tar.gz'),
+                         'tar -xzf /root/a.tar.gz -C / && rm -f /root/a.tar.gz')
+
+    def test_relative_remote_path_is_rejected(self):
+        self.assertRaises(ValueError, ContextBundle, [(self.files[0][0], 'cert.pem')])
+
+    def test_shared_bundle_follows_file_changes(self):
+        bundle = get_bundle(self.files)
+        self.assertTrue(get_bundle(self.files) is bundle)
+
+        path = self.files[0][0]
+        with open(path, 'w') as f:
+            f.write('new certificate')
+        os.utime(path, (time.time() + 10, time.time() + 10))
+
+        new_bundle = get_bundle(self.files)
+        self.assertFalse(new_bundle is bundle)
+        self.assertEqual(self._members(new_bundle.archive())['root/cert.pem'],
+                         'new certificate')
+
+
+if __name__ == "__main__":
+    unittest.main()
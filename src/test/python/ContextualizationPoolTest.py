@@ -0,0 +1,92 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import threading
+import time
+import unittest
+
+from stratuslab.dirac.contextualization import ContextualizationPool, ContextFuture
+
+
+class ContextualizationPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ContextualizationPool(max_workers=8)
+
+    def test_result_and_callback(self):
+        called = []
+        future = self.pool.submit(lambda x, y: x + y, 1, y=2)
+        future.add_done_callback(lambda f: called.append(f.result()))
+        self.assertEqual(future.result(timeout=5), 3)
+        self.assertTrue(future.done())
+
+        # callbacks added after completion are called immediately
+        future.add_done_callback(lambda f: called.append(f.result()))
+        self.assertEqual(called, [3, 3])
+
+    def test_exception_is_raised_by_result(self):
+        def fail():
+            raise ValueError('no route to host')
+        future = self.pool.submit(fail)
+        self.assertRaises(ValueError, future.result, 5)
+
+    def test_jobs_run_in_parallel(self):
+        start = time.time()
+        futures = self.pool.map(time.sleep, [(0.2,)] * 8)
+        for future in futures:
+            future.result(timeout=5)
+        self.assertTrue(time.time() - start < 1.0)
+
+    def test_sessions_are_limited_per_key(self):
+        lock = threading.Lock()
+        active = {'a': 0, 'b': 0}
+        peak = {'a': 0, 'b': 0}
+
+        def job(key):
+            with self.pool.session(key, limit=2):
+                with lock:
+                    active[key] += 1
+                    peak[key] = max(peak[key], active[key])
+                time.sleep(0.05)
+                with lock:
+                    active[key] -= 1
+
+        futures = self.pool.map(job, [('a',), ('b',)] * 4)
+        for future in futures:
+            future.result(timeout=5)
+
+        self.assertTrue(peak['a'] <= 2 and peak['b'] <= 2)
+
+    def test_future_completed_by_caller(self):
+        called = []
+        future = ContextFuture()
+        future.add_done_callback(lambda f: called.append(f.result()))
+        self.assertFalse(future.done())
+        future.set_result(42)
+        self.assertTrue(future.done())
+        future.add_done_callback(lambda f: called.append(f.result()))
+        self.assertEqual(called, [42, 42])
+
+    def test_result_timeout(self):
+        event = threading.Event()
+        future = self.pool.submit(event.wait)
+        self.assertRaises(Exception, future.result, 0.01)
+        event.set()
+        future.result(timeout=5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,225 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from StringIO import StringIO
+
+import stratuslab_stubs
+
+from stratuslab.dirac.tracing import Tracer
+
+# set by setUpModule, once paramiko is replaced by the fake below
+DiracSshContext = None
+
+_saved_modules = None
+
+
+class FakeChannel(object):
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.command = None
+        self.output = []
+
+    def set_combine_stderr(self, combine):
+        pass
+
+    def exec_command(self, command):
+        self.command = command
+        self.transport.commands.append(command)
+        if command.startswith('/bin/bash'):
+            self.output = ['x' * 32768] * 3
+
+    def makefile(self, mode):
+        return StringIO('')
+
+    def recv(self, size):
+        # the script output is released by the test through script_done
+        self.transport.script_done.wait(5)
+        if self.output:
+            chunk = self.output.pop()
+            self.transport.drained += len(chunk)
+            return chunk
+        return ''
+
+    def recv_exit_status(self):
+        command = self.command.split()[0]
+        return self.transport.statuses.get(command, 0)
+
+    def close(self):
+        pass
+
+
+class FakeTransport(object):
+
+    instances = []
+    statuses = {}
+
+    def __init__(self, address):
+        self.address = address
+        self.commands = []
+        self.statuses = dict(FakeTransport.statuses)
+        self.script_done = threading.Event()
+        self.drained = 0
+        self.closed = threading.Event()
+        FakeTransport.instances.append(self)
+
+    def connect(self, username=None, pkey=None):
+        pass
+
+    def open_session(self):
+        return FakeChannel(self)
+
+    def close(self):
+        self.closed.set()
+
+
+class FakeSFTPClient(object):
+
+    uploads = []
+
+    @staticmethod
+    def from_transport(transport):
+        return FakeSFTPClient()
+
+    def putfo(self, stream, path):
+        FakeSFTPClient.uploads.append(path)
+
+    def close(self):
+        pass
+
+
+class FakeRSAKey(object):
+
+    @staticmethod
+    def from_private_key_file(path):
+        return FakeRSAKey()
+
+
+def setUpModule():
+    global DiracSshContext, _saved_modules
+
+    paramiko = imp.new_module('paramiko')
+    paramiko.Transport = FakeTransport
+    paramiko.SFTPClient = FakeSFTPClient
+    paramiko.RSAKey = FakeRSAKey
+
+    _saved_modules = {'paramiko': sys.modules.get('paramiko'),
+                      'stratuslab.dirac.DiracSshContext':
+                          sys.modules.pop('stratuslab.dirac.DiracSshContext', None)}
+    sys.modules['paramiko'] = paramiko
+
+    from stratuslab.dirac.DiracSshContext import DiracSshContext
+
+
+def tearDownModule():
+    stratuslab_stubs.uninstall(_saved_modules)
+
+
+class SpanRecorder(object):
+
+    def __init__(self):
+        self.spans = {}
+
+    def export(self, span):
+        self.spans[span.name] = span
+
+
+class DiracSshContextTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeTransport.instances = []
+        FakeTransport.statuses = {}
+        FakeSFTPClient.uploads = []
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.paths = []
+        for name in ['cert.pem', 'key.pem', 'contextualize-script.bash']:
+            path = os.path.join(self.tmp_dir, name)
+            with open(path, 'w') as f:
+                f.write(name)
+            self.paths.append(path)
+
+        self.recorder = SpanRecorder()
+        self.span = Tracer(self.recorder).start_span('contextualize', 'Dirac-1')
+
+    def tearDown(self):
+        for transport in FakeTransport.instances:
+            transport.script_done.set()
+        shutil.rmtree(self.tmp_dir)
+
+    def contextualise(self):
+        cert, key, script = self.paths
+        return DiracSshContext.sshContextualise('Dirac-1', '10.0.0.1', 'StratusLab',
+                                                'http://proxy:3128', 'never', 'ssh',
+                                                cert, key, script,
+                                                'run-job', 'vm-monitor', 'vm-updater',
+                                                'log', 'cvmfs', 'dirac', 'SITE-A', 1000,
+                                                span=self.span)
+
+    def test_single_transport_for_all_steps(self):
+        result = self.contextualise()
+        self.assertTrue(result['OK'])
+
+        self.assertEqual(len(FakeTransport.instances), 1)
+        transport = FakeTransport.instances[0]
+        self.assertEqual([command.split()[0] for command in transport.commands],
+                         ['sha256sum', 'tar', '/bin/bash'])
+        self.assertEqual(len(FakeSFTPClient.uploads), 1)
+
+        # the connection stays open, and the step unfinished, until the
+        # script has exited and its output has been read
+        self.assertFalse(transport.closed.is_set())
+        self.assertFalse('contextualize_script' in self.recorder.spans)
+
+        transport.script_done.set()
+        self.assertTrue(transport.closed.wait(5))
+        self.assertEqual(transport.drained, 3 * 32768)
+
+        step = self.recorder.spans['contextualize_script']
+        self.assertEqual(step.error, None)
+        self.assertEqual(step.attributes['exitStatus'], 0)
+
+    def test_failed_extraction(self):
+        FakeTransport.statuses = {'tar': 2}
+
+        result = self.contextualise()
+        self.assertFalse(result['OK'])
+
+        transport = FakeTransport.instances[0]
+        self.assertTrue(transport.closed.is_set())
+        self.assertFalse('/bin/bash' in [command.split()[0] for command in transport.commands])
+        self.assertTrue(self.recorder.spans['transfer'].error is not None)
+
+    def test_failed_script_is_recorded(self):
+        FakeTransport.statuses = {'/bin/bash': 1}
+
+        self.assertTrue(self.contextualise()['OK'])
+
+        transport = FakeTransport.instances[0]
+        transport.script_done.set()
+        self.assertTrue(transport.closed.wait(5))
+        self.assertEqual(self.recorder.spans['contextualize_script'].error, 'exit status 1')
+
+
+if __name__ == "__main__":
+    unittest.main()
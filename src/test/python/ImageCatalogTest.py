@@ -0,0 +1,68 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import unittest
+
+from stratuslab.libcloud.image_catalog import ImageCatalog
+
+
+class _Image(object):
+
+    def __init__(self, image_id):
+        self.id = image_id
+
+
+class ImageCatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.catalog = ImageCatalog()
+        self.catalog.add(_Image('A'), title='ubuntu', description='Ubuntu 12.04 base')
+        self.catalog.add(_Image('B'), title='centos', description='CentOS 6.2 base')
+        self.catalog.add(_Image('C'), title='ubuntu', description='Ubuntu 10.04 base')
+        self.catalog.add(_Image('D'))
+
+    def test_lookup_by_id(self):
+        self.assertEqual(len(self.catalog), 4)
+        self.assertEqual(self.catalog.get('B').id, 'B')
+        self.assertTrue('D' in self.catalog)
+        self.assertEqual(self.catalog.get('missing'), None)
+
+    def test_first_entry_for_identifier_is_kept(self):
+        first = self.catalog.get('A')
+        self.assertTrue(self.catalog.add(_Image('A'), title='other') is first)
+        self.assertEqual(self.catalog.find_by_title('other'), [])
+
+    def test_lookup_by_title(self):
+        ids = [image.id for image in self.catalog.find_by_title('ubuntu')]
+        self.assertEqual(ids, ['A', 'C'])
+        self.assertEqual(self.catalog.find_by_title('missing'), [])
+
+    def test_lookup_by_description_prefix(self):
+        ids = [image.id for image in self.catalog.find_by_description_prefix('Ubuntu')]
+        self.assertEqual(ids, ['C', 'A'])
+
+        ids = [image.id for image in self.catalog.find_by_description_prefix('Cent')]
+        self.assertEqual(ids, ['B'])
+
+        self.catalog.add(_Image('E'), description='Ubuntu 13.04 base')
+        ids = [image.id for image in self.catalog.find_by_description_prefix('Ubuntu 1')]
+        self.assertEqual(ids, ['C', 'A', 'E'])
+
+        self.assertEqual(self.catalog.find_by_description_prefix('Zzz'), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
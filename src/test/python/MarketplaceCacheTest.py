@@ -0,0 +1,111 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import shutil
+import tempfile
+import threading
+import unittest
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from stratuslab.libcloud.marketplace_cache import MarketplaceCache
+
+
+class _MetadataHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.getheader('If-None-Match'))
+
+        etag = '"%d"' % server.version
+        if self.headers.getheader('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = 'metadata version %d' % server.version
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MarketplaceCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), _MetadataHandler)
+        self.server.requests = []
+        self.server.version = 1
+
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.url = 'http://127.0.0.1:%d/metadata' % self.server.server_port
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def _read(self, cache):
+        stream = cache.open(self.url)
+        try:
+            return stream.read()
+        finally:
+            stream.close()
+
+    def test_fresh_copy_is_used_without_request(self):
+        cache = MarketplaceCache(self.cache_dir, max_age=3600)
+        self.assertEqual(self._read(cache), 'metadata version 1')
+        self.assertEqual(self._read(cache), 'metadata version 1')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_cache_is_shared_between_instances(self):
+        self._read(MarketplaceCache(self.cache_dir, max_age=3600))
+        self._read(MarketplaceCache(self.cache_dir, max_age=3600))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_stale_copy_is_revalidated(self):
+        cache = MarketplaceCache(self.cache_dir, max_age=0)
+        self.assertEqual(self._read(cache), 'metadata version 1')
+        self.assertEqual(self._read(cache), 'metadata version 1')
+        self.assertEqual(self.server.requests, [None, '"1"'])
+
+    def test_modified_document_is_downloaded(self):
+        cache = MarketplaceCache(self.cache_dir, max_age=0)
+        self._read(cache)
+        self.server.version = 2
+        self.assertEqual(self._read(cache), 'metadata version 2')
+        self.assertEqual(self._read(cache), 'metadata version 2')
+        self.assertEqual(self.server.requests, [None, '"1"', '"2"'])
+
+    def test_partial_read_is_not_cached(self):
+        cache = MarketplaceCache(self.cache_dir, max_age=3600)
+        stream = cache.open(self.url)
+        stream.read(4)
+        stream.close()
+        self.assertEqual(self._read(cache), 'metadata version 1')
+        self.assertEqual(len(self.server.requests), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
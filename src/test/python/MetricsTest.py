@@ -0,0 +1,79 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import unittest
+
+from stratuslab.libcloud.metrics import HistogramMetrics, NullMetrics
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = HistogramMetrics(buckets=(0.1, 1.0))
+
+    def test_null_metrics_do_not_hide_errors(self):
+        def fail():
+            with NullMetrics().timer('listVms', 'a'):
+                raise ValueError('failure')
+        self.assertRaises(ValueError, fail)
+
+    def test_observations_are_bucketed(self):
+        for seconds in (0.05, 0.1, 0.5, 2.0):
+            self.metrics.observe('listVms', 'a', seconds)
+        self.metrics.observe('listVms', 'b', 0.5, error=True)
+
+        values = self.metrics.snapshot()[('listVms', 'a')]
+        self.assertEqual(values['count'], 4)
+        self.assertEqual(values['errors'], 0)
+        self.assertAlmostEqual(values['sum'], 2.65)
+        self.assertEqual(values['buckets'],
+                         [(0.1, 2), (1.0, 3), (float('inf'), 4)])
+
+        self.assertEqual(self.metrics.snapshot()[('listVms', 'b')]['errors'], 1)
+
+    def test_timer_records_errors(self):
+        with self.metrics.timer('vmDetail', 'a'):
+            pass
+
+        def fail():
+            with self.metrics.timer('vmDetail', 'a'):
+                raise ValueError('failure')
+        self.assertRaises(ValueError, fail)
+
+        values = self.metrics.snapshot()[('vmDetail', 'a')]
+        self.assertEqual(values['count'], 2)
+        self.assertEqual(values['errors'], 1)
+
+    def test_prometheus_export(self):
+        self.metrics.observe('runInstance', 'a', 0.5, error=True)
+        text = self.metrics.to_prometheus()
+
+        labels = 'operation="runInstance",location="a"'
+        self.assertTrue('# TYPE stratuslab_operation_duration_seconds histogram' in text)
+        self.assertTrue('stratuslab_operation_duration_seconds_bucket{%s,le="0.1"} 0' % labels in text)
+        self.assertTrue('stratuslab_operation_duration_seconds_bucket{%s,le="1.0"} 1' % labels in text)
+        self.assertTrue('stratuslab_operation_duration_seconds_bucket{%s,le="+Inf"} 1' % labels in text)
+        self.assertTrue('stratuslab_operation_duration_seconds_count{%s} 1' % labels in text)
+        self.assertTrue('stratuslab_operation_errors_total{%s} 1' % labels in text)
+
+    def test_reset(self):
+        self.metrics.observe('listVms', 'a', 0.5)
+        self.metrics.reset()
+        self.assertEqual(self.metrics.snapshot(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
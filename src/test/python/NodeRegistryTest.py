@@ -0,0 +1,88 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from stratuslab.libcloud.registry import NodeRegistry
+
+
+def _node(node_id, state=0, public_ip=None):
+    return {'node_id': node_id,
+            'name': 'node-%s' % node_id,
+            'state': state,
+            'public_ip': public_ip,
+            'cpu': 1,
+            'ram': 128,
+            'disk': 1024,
+            'image_id': 'IMAGE'}
+
+
+class NodeRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'registry.db')
+        self.registry = NodeRegistry(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_empty_registry(self):
+        self.assertEqual(self.registry.load_nodes(), {})
+        self.assertEqual(self.registry.load_images(), {})
+        self.assertEqual(self.registry.updated('a'), None)
+
+    def test_nodes_are_persistent(self):
+        self.registry.save_nodes('a', [_node('1'), _node('2', 1, '1.2.3.4')])
+        self.registry.save_nodes('b', [])
+
+        nodes = NodeRegistry(self.path).load_nodes()
+        self.assertEqual(sorted(nodes.keys()), ['a', 'b'])
+        self.assertEqual(nodes['b'], [])
+        self.assertEqual([n['node_id'] for n in nodes['a']], ['1', '2'])
+        self.assertEqual(nodes['a'][1]['state'], 1)
+        self.assertEqual(nodes['a'][1]['public_ip'], '1.2.3.4')
+        self.assertEqual(nodes['a'][1]['cpu'], '1')
+        self.assertTrue(self.registry.updated('a') is not None)
+
+    def test_nodes_of_location_are_replaced(self):
+        self.registry.save_nodes('a', [_node('1'), _node('2')])
+        self.registry.save_nodes('b', [_node('3')])
+        self.registry.save_nodes('a', [_node('2', 1)])
+
+        nodes = self.registry.load_nodes('a')
+        self.assertEqual(nodes.keys(), ['a'])
+        self.assertEqual([(n['node_id'], n['state']) for n in nodes['a']],
+                         [('2', 1)])
+        self.assertEqual(len(self.registry.load_nodes()['b']), 1)
+
+    def test_images_are_replaced_and_keep_first_entry(self):
+        url = 'https://marketplace.example.org'
+        self.registry.save_images(url, [{'image_id': 'A', 'name': 'old'}])
+        self.registry.save_images(url, [{'image_id': 'B', 'name': 'b'},
+                                        {'image_id': 'C', 'name': 'first'},
+                                        {'image_id': 'C', 'name': 'second'}])
+
+        images = self.registry.load_images()[url]
+        self.assertEqual([(i['image_id'], i['name']) for i in images],
+                         [('B', 'b'), ('C', 'first')])
+
+
+if __name__ == "__main__":
+    unittest.main()
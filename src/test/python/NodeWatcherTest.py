@@ -0,0 +1,125 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import Queue
+import time
+import unittest
+
+from stratuslab.libcloud.node_watcher import NodeWatcher, NodeEvent, diff_snapshots
+
+
+class _Location(object):
+
+    def __init__(self, location_id):
+        self.id = location_id
+
+
+class NodeWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.location = _Location('site')
+        self.snapshot = {'1': (3, None), '2': (3, None)}
+        self.polls = 0
+        self.watcher = NodeWatcher(self.fetch, interval=0.05)
+
+    def tearDown(self):
+        self.watcher.stop()
+
+    def fetch(self, location):
+        self.polls += 1
+        return dict(self.snapshot)
+
+    def events(self, queue, count):
+        return [queue.get(timeout=5) for _ in range(count)]
+
+    def test_diff_snapshots(self):
+        added, removed, changed = diff_snapshots({'1': 'a', '2': 'b', '3': 'c'},
+                                                 {'2': 'b', '3': 'x', '4': 'd'})
+        self.assertEqual(added, set(['4']))
+        self.assertEqual(removed, set(['1']))
+        self.assertEqual(changed, set(['3']))
+
+    def test_initial_events_describe_current_nodes(self):
+        queue = Queue.Queue()
+        self.watcher.subscribe(self.location, queue=queue)
+        events = self.events(queue, 2)
+        self.assertEqual(sorted([e.node_id for e in events]), ['1', '2'])
+        self.assertEqual(set([e.kind for e in events]), set([NodeEvent.ADDED]))
+
+    def test_changes_are_sent_to_matching_watchers(self):
+        all_nodes = Queue.Queue()
+        one_node = Queue.Queue()
+        self.watcher.subscribe(self.location, queue=all_nodes)
+        self.watcher.subscribe(self.location, node_ids=['1'], queue=one_node)
+        self.events(all_nodes, 2)
+        self.events(one_node, 1)
+
+        self.snapshot = {'1': (0, '10.0.0.1'), '3': (3, None)}
+
+        kinds = sorted([(e.node_id, e.kind) for e in self.events(all_nodes, 4)])
+        self.assertEqual(kinds, [('1', NodeEvent.IP), ('1', NodeEvent.STATE),
+                                 ('2', NodeEvent.REMOVED), ('3', NodeEvent.ADDED)])
+
+        kinds = sorted([(e.node_id, e.kind) for e in self.events(one_node, 2)])
+        self.assertEqual(kinds, [('1', NodeEvent.IP), ('1', NodeEvent.STATE)])
+
+    def test_poller_stops_with_last_subscription(self):
+        queue = Queue.Queue()
+        subscriptions = [self.watcher.subscribe(self.location, queue=queue),
+                         self.watcher.subscribe(self.location, callback=lambda e: None)]
+        self.events(queue, 2)
+
+        for subscription in subscriptions:
+            subscription.cancel()
+
+        polls = self.polls
+        time.sleep(0.2)
+        self.assertTrue(self.polls <= polls + 1)
+
+    def test_failing_callback_does_not_stop_other_watchers(self):
+        def fail(event):
+            raise ValueError('broken watcher')
+
+        queue = Queue.Queue()
+        self.watcher.subscribe(self.location, callback=fail)
+        self.watcher.subscribe(self.location, queue=queue)
+        self.assertEqual(len(self.events(queue, 2)), 2)
+
+    def test_last_error_reports_failing_polls(self):
+        def fetch(location):
+            if self.fail:
+                raise IOError('location unreachable')
+            return dict(self.snapshot)
+
+        self.fail = True
+        watcher = NodeWatcher(fetch, interval=0.05)
+        try:
+            self.assertEqual(watcher.last_error(self.location), None)
+
+            queue = Queue.Queue()
+            watcher.subscribe(self.location, queue=queue)
+            time.sleep(0.1)
+            self.assertTrue(isinstance(watcher.last_error(self.location), IOError))
+
+            self.fail = False
+            self.events(queue, 2)
+            self.assertEqual(watcher.last_error(self.location), None)
+        finally:
+            watcher.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
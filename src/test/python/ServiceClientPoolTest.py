@@ -0,0 +1,94 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import unittest
+
+from stratuslab.libcloud.client_pool import ServiceClientPool
+
+
+class ServiceClientPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.created = []
+
+    def factory(self):
+        client = object()
+        self.created.append(client)
+        return client
+
+    def test_client_is_reused(self):
+        pool = ServiceClientPool()
+        with pool.client('a', self.factory) as first:
+            pass
+        with pool.client('a', self.factory) as second:
+            pass
+        self.assertTrue(first is second)
+        self.assertEqual(len(self.created), 1)
+
+    def test_clients_are_separated_by_key(self):
+        pool = ServiceClientPool()
+        with pool.client('a', self.factory):
+            pass
+        with pool.client('b', self.factory):
+            pass
+        self.assertEqual(len(self.created), 2)
+        self.assertEqual(pool.idle_count(), 2)
+
+    def test_client_in_use_is_not_shared(self):
+        pool = ServiceClientPool()
+        with pool.client('a', self.factory) as first:
+            with pool.client('a', self.factory) as second:
+                self.assertFalse(first is second)
+        self.assertEqual(pool.idle_count('a'), 2)
+
+    def test_failed_client_is_dropped(self):
+        pool = ServiceClientPool()
+        try:
+            with pool.client('a', self.factory):
+                raise ValueError('failure')
+        except ValueError:
+            pass
+        self.assertEqual(pool.idle_count(), 0)
+
+    def test_idle_client_is_evicted(self):
+        pool = ServiceClientPool(idle_timeout=-1)
+        with pool.client('a', self.factory):
+            pass
+        with pool.client('a', self.factory):
+            pass
+        self.assertEqual(len(self.created), 2)
+
+        pool.evict_idle()
+        self.assertEqual(pool.idle_count(), 0)
+
+    def test_unhealthy_client_is_replaced(self):
+        pool = ServiceClientPool(health_check=lambda client: False)
+        with pool.client('a', self.factory):
+            pass
+        with pool.client('a', self.factory):
+            pass
+        self.assertEqual(len(self.created), 2)
+
+    def test_number_of_idle_clients_is_bounded(self):
+        pool = ServiceClientPool(max_idle=1)
+        with pool.client('a', self.factory):
+            with pool.client('a', self.factory):
+                pass
+        self.assertEqual(pool.idle_count('a'), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import socket
+import threading
+import time
+import unittest
+
+from stratuslab.dirac.ssh_probe import SshProber
+
+
+class _BannerServer(object):
+    """
+    Local TCP server sending the given lines to each client.
+    """
+
+    def __init__(self, lines, port=0):
+        self.lines = lines
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', port))
+        self.sock.listen(16)
+        self.address = self.sock.getsockname()
+
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except socket.error:
+                return
+            for line in self.lines:
+                client.sendall(line + '\r\n')
+            time.sleep(0.1)
+            client.close()
+
+    def close(self):
+        self.sock.close()
+
+
+def _unused_address():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    address = sock.getsockname()
+    sock.close()
+    return address
+
+
+class SshProberTest(unittest.TestCase):
+
+    def setUp(self):
+        self.prober = SshProber(retry_interval=0.1, connect_timeout=1)
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+
+    def _server(self, lines, port=0):
+        server = _BannerServer(lines, port)
+        self.servers.append(server)
+        return server.address
+
+    def test_ssh_server_is_ready(self):
+        address = self._server(['SSH-2.0-OpenSSH_5.3'])
+        self.assertTrue(self.prober.wait(address, timeout=5))
+
+    def test_lines_before_identification_are_skipped(self):
+        address = self._server(['Welcome', 'SSH-2.0-OpenSSH_5.3'])
+        self.assertTrue(self.prober.wait(address, timeout=5))
+
+    def test_other_service_is_not_ready(self):
+        address = self._server(['220 smtp.example.org ESMTP'])
+        self.assertFalse(self.prober.wait(address, timeout=0.5))
+
+    def test_closed_port_is_not_ready(self):
+        self.assertFalse(self.prober.wait(_unused_address(), timeout=0.5))
+
+    def test_service_started_later_is_detected(self):
+        address = _unused_address()
+
+        timer = threading.Timer(0.3, self._server,
+                                args=(['SSH-2.0-OpenSSH_5.3'], address[1]))
+        timer.start()
+        try:
+            self.assertTrue(self.prober.wait(address, timeout=5))
+        finally:
+            timer.join()
+
+    def test_many_addresses_at_once(self):
+        ready = [self._server(['SSH-2.0-OpenSSH_5.3']) for _ in range(10)]
+        closed = [_unused_address() for _ in range(3)]
+
+        start = time.time()
+        result = self.prober.wait_all(ready + closed, timeout=1)
+
+        self.assertEqual(sorted(result), sorted(ready))
+        self.assertTrue(time.time() - start < 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
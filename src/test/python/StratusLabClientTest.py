@@ -0,0 +1,107 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import unittest
+
+import stratuslab_stubs
+
+# set by setUpModule, once the StratusLab client modules are stubbed
+client_module = None
+StratusLabClient = None
+
+_saved_modules = None
+
+
+def setUpModule():
+    global client_module, StratusLabClient, _saved_modules
+
+    _saved_modules = stratuslab_stubs.install(['stratuslab.libcloud.compute_driver',
+                                               'stratuslab.dirac.StratusLabClient'])
+
+    from stratuslab.dirac import StratusLabClient as client_module
+    StratusLabClient = client_module.StratusLabClient
+
+
+def tearDownModule():
+    stratuslab_stubs.uninstall(_saved_modules)
+
+
+class FakeDriver(object):
+
+    def __init__(self, key, stratuslab_user_config=None):
+        self.config = stratuslab_user_config.getvalue()
+
+
+class StratusLabClientTest(unittest.TestCase):
+
+    ENDPOINT = {'ex_endpoint': 'cloud.example.org',
+                'ex_username': 'user',
+                'ex_password': 'secret',
+                'siteName': 'SITE-A',
+                'maxContextSessions': '4'}
+
+    def setUp(self):
+        self.created = []
+        self._get_driver = client_module.get_driver
+        client_module.get_driver = self.get_driver
+        StratusLabClient.clear_drivers()
+
+    def tearDown(self):
+        client_module.get_driver = self._get_driver
+        StratusLabClient.clear_drivers()
+
+    def get_driver(self, provider):
+        self.assertEqual(provider, 'STRATUSLAB')
+
+        def create(*args, **kwargs):
+            driver = FakeDriver(*args, **kwargs)
+            self.created.append(driver)
+            return driver
+        return create
+
+    def endpoint(self, **params):
+        endpoint = dict(self.ENDPOINT)
+        endpoint.update(params)
+        return endpoint
+
+    def test_same_endpoint_shares_driver(self):
+        driver = StratusLabClient._get_driver(self.endpoint())
+        self.assertTrue(StratusLabClient._get_driver(self.endpoint()) is driver)
+        self.assertEqual(len(self.created), 1)
+        self.assertTrue('endpoint = cloud.example.org' in driver.config)
+
+    def test_other_parameters_do_not_change_driver(self):
+        driver = StratusLabClient._get_driver(self.endpoint())
+        other = StratusLabClient._get_driver(self.endpoint(siteName='SITE-B',
+                                                           maxContextSessions='8'))
+        self.assertTrue(other is driver)
+        self.assertEqual(StratusLabClient._driver_key(self.endpoint()),
+                         StratusLabClient._driver_key(self.endpoint(siteName='SITE-B')))
+
+    def test_different_endpoint_parameters_use_different_drivers(self):
+        driver = StratusLabClient._get_driver(self.endpoint())
+        other = StratusLabClient._get_driver(self.endpoint(ex_username='other'))
+        self.assertFalse(other is driver)
+        self.assertEqual(len(self.created), 2)
+
+    def test_clear_drivers(self):
+        driver = StratusLabClient._get_driver(self.endpoint())
+        StratusLabClient.clear_drivers()
+        self.assertFalse(StratusLabClient._get_driver(self.endpoint()) is driver)
+
+
+if __name__ == "__main__":
+    unittest.main()
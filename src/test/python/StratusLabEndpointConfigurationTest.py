@@ -77,6 +77,7 @@ class StratusLabEndpointConfigurationTest(unittest.TestCase):
     def test_all_parameters(self):
         all_keys = StratusLabEndpointConfiguration.DIRAC_REQUIRED_KEYS
         all_keys = all_keys.union(StratusLabEndpointConfiguration.STRATUSLAB_REQUIRED_KEYS)
+        all_keys = all_keys.union(StratusLabEndpointConfiguration.DIRAC_OPTIONAL_KEYS)
         all_keys = all_keys.union(StratusLabEndpointConfiguration.STRATUSLAB_OPTIONAL_KEYS)
         value = {}
         for key in all_keys:
@@ -0,0 +1,485 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from StringIO import StringIO
+
+import stratuslab_stubs
+from stratuslab_stubs import CLOUD, vm_attrs
+
+from stratuslab.libcloud.metrics import HistogramMetrics
+
+from libcloud.compute.base import NodeImage
+from libcloud.compute.types import NodeState
+from libcloud.common.types import LibcloudError
+
+CONFIG = """
+[default]
+endpoint = cloud.example.org
+
+[site-a]
+endpoint = a.example.org
+
+[site-b]
+endpoint = b.example.org
+"""
+
+METADATA_ENTRY = """
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+         xmlns:dcterms="http://purl.org/dc/terms/">
+  <rdf:Description>
+    <dcterms:identifier>%s</dcterms:identifier>
+    <dcterms:title>%s</dcterms:title>
+  </rdf:Description>
+</rdf:RDF>
+"""
+
+
+def marketplace_metadata(images):
+    entries = ''.join([METADATA_ENTRY % image for image in images])
+    return '<metadata>%s</metadata>' % entries
+
+
+# set by setUpModule, once the StratusLab client modules are stubbed
+compute_driver = None
+StratusLabNodeDriver = None
+StratusLabNodeRecord = None
+
+_saved_modules = None
+
+
+def setUpModule():
+    global compute_driver, StratusLabNodeDriver, StratusLabNodeRecord, _saved_modules
+
+    _saved_modules = stratuslab_stubs.install(['stratuslab.libcloud.compute_driver'])
+
+    from stratuslab.libcloud import compute_driver
+    StratusLabNodeDriver = compute_driver.StratusLabNodeDriver
+    StratusLabNodeRecord = compute_driver.StratusLabNodeRecord
+
+
+def tearDownModule():
+    stratuslab_stubs.uninstall(_saved_modules)
+
+
+class StratusLabNodeDriverTest(unittest.TestCase):
+
+    def setUp(self):
+        CLOUD.reset()
+        self.driver = self.create_driver()
+        self.site_a = self.driver.locations['site-a']
+
+    def create_driver(self, **kwargs):
+        kwargs.setdefault('stratuslab_user_config', StringIO(CONFIG))
+        kwargs.setdefault('stratuslab_default_location', 'site-a')
+        kwargs.setdefault('stratuslab_marketplace_cache_dir', None)
+        return StratusLabNodeDriver('unused', **kwargs)
+
+    def test_wait_until_running_polls_all_nodes_together(self):
+        CLOUD.vms['site-a'] = [vm_attrs(1, state='Pending'), vm_attrs(2, state='Pending')]
+        nodes = self.driver.list_nodes_in_location(self.site_a)
+        del CLOUD.calls[:]
+
+        def boot():
+            CLOUD.vms['site-a'] = [vm_attrs(1, ip='10.0.0.1'), vm_attrs(2, ip='10.0.0.2')]
+        timer = threading.Timer(0.1, boot)
+        timer.start()
+
+        self.driver.WAIT_INTERVALS = {'pending': 0.02}
+        result = self.driver.wait_until_running(nodes, timeout=5)
+        timer.join()
+
+        self.assertEqual([(node.id, ips) for node, ips in result],
+                         [('1', ['10.0.0.1']), ('2', ['10.0.0.2'])])
+        detail_calls = [call for call in CLOUD.calls if call[0] == 'vmDetail']
+        self.assertTrue(len(detail_calls) > 1)
+        for call in detail_calls:
+            self.assertEqual(sorted(call[2]), ['1', '2'])
+
+    def test_wait_until_running_backs_off_while_state_is_unchanged(self):
+        CLOUD.vms['site-a'] = [vm_attrs(1, state='Prolog')]
+        nodes = self.driver.list_nodes_in_location(self.site_a)
+
+        sleeps = []
+
+        class Clock(object):
+            time = staticmethod(time.time)
+
+            @staticmethod
+            def sleep(seconds):
+                sleeps.append(seconds)
+                if len(sleeps) == 5:
+                    CLOUD.vms['site-a'] = [vm_attrs(1, ip='10.0.0.1')]
+
+        compute_driver.time = Clock
+        try:
+            self.driver.wait_until_running(nodes)
+        finally:
+            compute_driver.time = time
+
+        self.assertEqual(sleeps, [10, 15, 22.5, 30, 30])
+
+    def test_wait_until_running_fails_for_terminated_nodes(self):
+        CLOUD.vms['site-a'] = [vm_attrs(1, state='Done')]
+        nodes = self.driver.list_nodes_in_location(self.site_a)
+        self.assertRaises(LibcloudError, self.driver.wait_until_running, nodes)
+
+    def test_wait_until_running_times_out(self):
+        CLOUD.vms['site-a'] = [vm_attrs(1, state='Boot')]
+        nodes = self.driver.list_nodes_in_location(self.site_a)
+        start = time.time()
+        self.assertRaises(LibcloudError, self.driver.wait_until_running, nodes,
+                          timeout=0.2)
+        self.assertTrue(time.time() - start < 2)
+
+    def test_slow_locations_time_out(self):
+        CLOUD.vms['site-a'] = [vm_attrs(1)]
+        CLOUD.vms['site-b'] = [vm_attrs(2)]
+        CLOUD.delays['site-b'] = 1
+
+        start = time.time()
+        nodes, errors = self.driver.ex_list_nodes(timeout=0.2)
+
+        self.assertTrue(time.time() - start < 0.8)
+        self.assertEqual([node.id for node in nodes], ['1'])
+        self.assertEqual(errors.keys(), ['site-b'])
+
+    def test_queued_locations_time_out(self):
+        # with a single worker, site-b waits for the slow site-a
+        driver = self.create_driver(stratuslab_max_workers=1)
+        CLOUD.delays['site-a'] = 1
+
+        locations = [driver.locations['site-a'], driver.locations['site-b']]
+        start = time.time()
+        nodes, errors = driver.ex_list_nodes(locations=locations, timeout=0.2)
+
+        self.assertTrue(time.time() - start < 0.8)
+        self.assertEqual(nodes, [])
+        self.assertEqual(sorted(errors.keys()), ['site-a', 'site-b'])
+
+    def test_location_workers_are_reused(self):
+        CLOUD.vms['site-a'] = [vm_attrs(1)]
+        CLOUD.delays['site-b'] = 0.5
+
+        self.driver.ex_list_nodes(timeout=0.1)
+        threads = threading.active_count()
+        for _ in range(5):
+            nodes, errors = self.driver.ex_list_nodes(timeout=0.1)
+            self.assertEqual([node.id for node in nodes], ['1'])
+            self.assertEqual(errors.keys(), ['site-b'])
+
+        # the calls stuck on site-b do not each leave a thread behind
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_iter_nodes_predicates(self):
+        CLOUD.vms['site-a'] = [vm_attrs(1, name='worker-1', image='IMAGE-A'),
+                               vm_attrs(2, name='worker-2', image='IMAGE-B', state='Pending'),
+                               vm_attrs(3, name='server', image='IMAGE-A', state='Done')]
+        CLOUD.vms['site-b'] = [vm_attrs(4, name='worker-4', image='IMAGE-A')]
+
+        def ids(**kwargs):
+            return sorted([node.id for node in self.driver.ex_iter_nodes(**kwargs)])
+
+        self.assertEqual(ids(), ['1', '2', '3', '4'])
+        self.assertEqual(ids(state=NodeState.RUNNING), ['1', '4'])
+        self.assertEqual(ids(state=[NodeState.PENDING, NodeState.TERMINATED]), ['2', '3'])
+        self.assertEqual(ids(image='IMAGE-B'), ['2'])
+        self.assertEqual(ids(name=lambda name: name.startswith('worker')), ['1', '2', '4'])
+        self.assertEqual(ids(state=NodeState.RUNNING, image='IMAGE-A',
+                             locations=[self.site_a]), ['1'])
+
+    def test_iter_nodes_collects_errors(self):
+        CLOUD.vms['site-a'] = [vm_attrs(1)]
+        CLOUD.errors['site-b'] = IOError('connection refused')
+
+        errors = {}
+        records = list(self.driver.ex_iter_nodes(compact=True, errors=errors))
+        self.assertEqual([record.id for record in records], ['1'])
+        self.assertTrue(isinstance(records[0], StratusLabNodeRecord))
+        self.assertEqual(errors.keys(), ['site-b'])
+
+    def test_listed_nodes_use_listing_as_snapshot(self):
+        CLOUD.vms['site-a'] = [vm_attrs(1, host='host-7', ip='10.0.0.1')]
+
+        node = self.driver.list_nodes()[0]
+        self.assertEqual(node.host, 'host-7')
+        self.assertEqual(node.state, NodeState.RUNNING)
+
+        node = list(self.driver.ex_iter_nodes(locations=[self.site_a]))[0]
+        self.assertEqual(node.host, 'host-7')
+
+        self.assertEqual(CLOUD.count('vmDetail'), 0)
+
+        # compact records are not affected
+        record = self.driver.list_nodes(ex_compact=True)[0]
+        self.assertEqual(record.to_node().host, 'host-7')
+        self.assertEqual(CLOUD.count('vmDetail'), 1)
+
+    def test_node_state_is_cached(self):
+        CLOUD.vms['site-a'] = [vm_attrs(1, ip='10.0.0.1')]
+        node = self.driver.list_nodes_in_location(self.site_a)[0]
+        del CLOUD.calls[:]
+
+        for _ in range(3):
+            self.assertEqual(node.state, NodeState.RUNNING)
+        self.assertEqual(node.host, 'host-1')
+        self.assertEqual(CLOUD.count('vmDetail'), 0)
+
+        # after invalidate(), the state and host share a single request
+        CLOUD.vms['site-a'] = [vm_attrs(1, state='Pending', host='host-2')]
+        node.invalidate()
+        self.assertEqual(node.state, NodeState.PENDING)
+        self.assertEqual(node.host, 'host-2')
+        self.assertEqual(CLOUD.count('vmDetail'), 1)
+
+    def test_node_state_cache_can_be_disabled(self):
+        driver = self.create_driver(stratuslab_state_ttl=0)
+        CLOUD.vms['site-a'] = [vm_attrs(1)]
+        node = driver.list_nodes_in_location(driver.locations['site-a'])[0]
+        del CLOUD.calls[:]
+
+        for _ in range(3):
+            self.assertEqual(node.state, NodeState.RUNNING)
+        self.assertEqual(CLOUD.count('vmDetail'), 3)
+
+    def test_refresh_nodes_reports_added_removed_and_changed(self):
+        CLOUD.vms['site-a'] = [vm_attrs(1), vm_attrs(2, state='Pending')]
+
+        delta = self.driver.ex_refresh_nodes(self.site_a)
+        self.assertEqual(sorted([n.id for n in delta.added]), ['1', '2'])
+        self.assertEqual(delta.removed, [])
+        self.assertEqual(delta.changed, [])
+        nodes = dict([(n.id, n) for n in delta.nodes])
+
+        CLOUD.vms['site-a'] = [vm_attrs(2, state='Running', ip='10.0.0.2'),
+                               vm_attrs(3)]
+
+        delta = self.driver.ex_refresh_nodes(self.site_a)
+        self.assertEqual([n.id for n in delta.added], ['3'])
+        self.assertEqual([n.id for n in delta.removed], ['1'])
+        self.assertEqual([n.id for n in delta.changed], ['2'])
+
+        # the existing node object is updated in place
+        node = delta.changed[0]
+        self.assertTrue(node is nodes['2'])
+        self.assertEqual(node.public_ips, ['10.0.0.2'])
+        self.assertEqual(node.get_attributes()['state_summary'], 'Running')
+
+    def test_refresh_nodes_ignores_usage_counters(self):
+        CLOUD.vms['site-a'] = [vm_attrs(1, cpu_usage=10, net_tx=100, last_poll=1)]
+        node = self.driver.ex_refresh_nodes(self.site_a).nodes[0]
+
+        CLOUD.vms['site-a'] = [vm_attrs(1, cpu_usage=80, net_tx=900, last_poll=2)]
+        delta = self.driver.ex_refresh_nodes(self.site_a)
+
+        self.assertEqual(delta.added, [])
+        self.assertEqual(delta.changed, [])
+        self.assertTrue(delta.nodes[0] is node)
+        # the snapshot still follows the latest listing
+        self.assertEqual(node.get_attributes()['last_poll'], 2)
+        self.assertEqual(CLOUD.count('vmDetail'), 0)
+
+    def test_created_nodes_do_not_share_extra(self):
+        image = NodeImage('IMAGE-A', 'IMAGE-A', self.driver)
+        size = self.driver.list_sizes()[0]
+        nodes = self.driver.ex_create_nodes(3, name='vm', size=size, image=image,
+                                            location=self.site_a)
+
+        self.assertEqual(len(nodes), 3)
+        self.assertEqual(CLOUD.count('runInstance'), 1)
+        nodes[0].extra['tag'] = 'first'
+        self.assertFalse('tag' in nodes[1].extra)
+        self.assertTrue(nodes[1].extra['location'] is self.site_a)
+
+    def list_both_sites(self):
+        CLOUD.vms['site-a'] = [vm_attrs(1), vm_attrs(2)]
+        CLOUD.vms['site-b'] = [vm_attrs(3)]
+        nodes = (self.driver.list_nodes_in_location(self.site_a) +
+                 self.driver.list_nodes_in_location(self.driver.locations['site-b']))
+        del CLOUD.calls[:]
+        return nodes
+
+    def test_destroy_nodes_kills_once_per_location(self):
+        nodes = self.list_both_sites()
+
+        self.assertTrue(self.driver.ex_destroy_nodes(nodes))
+
+        kills = sorted([call for call in CLOUD.calls if call[0] == 'killInstances'])
+        self.assertEqual(kills, [('killInstances', 'site-a', ('1', '2')),
+                                 ('killInstances', 'site-b', ('3',))])
+        self.assertEqual([node.state for node in nodes], [NodeState.TERMINATED] * 3)
+
+    def test_destroy_nodes_tries_every_location(self):
+        nodes = self.list_both_sites()
+        error = IOError('site-a unreachable')
+        CLOUD.errors['site-a'] = error
+
+        try:
+            self.driver.ex_destroy_nodes(nodes)
+            self.fail('the error of site-a must be raised')
+        except IOError as e:
+            self.assertTrue(e is error)
+
+        self.assertEqual(CLOUD.count('killInstances', 'site-b'), 1)
+        # only the nodes of site-b are known to be terminated
+        self.assertEqual([node.state for node in nodes],
+                         [NodeState.RUNNING, NodeState.RUNNING, NodeState.TERMINATED])
+
+    def test_iterating_images_does_not_build_catalog(self):
+        metadata = marketplace_metadata([('IMAGE-A', 'ubuntu'), ('IMAGE-B', 'centos')])
+        opened = []
+
+        def open_url(url):
+            opened.append(url)
+            return StringIO(metadata)
+        self.driver._open_marketplace_url = open_url
+
+        ids = [image.id for image in self.driver.ex_iter_images()]
+        self.assertEqual(ids, ['IMAGE-A', 'IMAGE-B'])
+        self.assertEqual(self.driver._image_catalogs, {})
+
+        images = self.driver.ex_find_images(title='centos')
+        self.assertEqual([image.id for image in images], ['IMAGE-B'])
+        self.assertEqual(len(opened), 2)
+
+        # the catalog built by ex_find_images answers get_image
+        self.assertEqual(self.driver.get_image('IMAGE-A').extra['title'], 'ubuntu')
+        self.assertEqual(len(opened), 2)
+
+    def test_client_health_check(self):
+        checked = []
+
+        def health_check(client):
+            checked.append(client)
+            return len(checked) > 1
+
+        driver = self.create_driver(stratuslab_client_health_check=health_check)
+        for _ in range(3):
+            driver.list_nodes_in_location(driver.locations['site-a'])
+
+        # the first reused client fails the check and is replaced
+        self.assertEqual(len(checked), 2)
+        self.assertEqual(CLOUD.count('Monitor', 'site-a'), 2)
+
+    def test_idle_clients_of_unused_locations_are_discarded(self):
+        driver = self.create_driver(stratuslab_client_idle_timeout=0.05)
+        driver.list_nodes_in_location(driver.locations['site-a'])
+        self.assertEqual(driver._client_pool.idle_count(), 1)
+
+        time.sleep(0.1)
+        driver.list_nodes_in_location(driver.locations['site-b'])
+        self.assertEqual(driver._client_pool.idle_count(), 1)
+
+    def test_watch_error_reports_failing_polls(self):
+        driver = self.create_driver(stratuslab_watch_interval=0.05)
+        self.assertEqual(driver.ex_watch_error(), None)
+
+        CLOUD.errors['site-a'] = IOError('location unreachable')
+        subscription = driver.ex_watch_location(callback=lambda event: None)
+        try:
+            time.sleep(0.15)
+            self.assertTrue(isinstance(driver.ex_watch_error(), IOError))
+            self.assertEqual(driver.ex_watch_error(driver.locations['site-b']), None)
+        finally:
+            subscription.cancel()
+
+    def test_config_file_is_reloaded_when_changed(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'stratuslab-user.cfg')
+            with open(path, 'w') as f:
+                f.write(CONFIG)
+
+            driver = self.create_driver(stratuslab_user_config=path)
+            site_a = driver.locations['site-a']
+            config = driver._get_location_config(site_a)
+            self.assertTrue(driver._get_location_config(site_a) is config)
+            self.assertEqual(config['endpoint'], 'a.example.org')
+
+            driver.list_nodes_in_location(site_a)
+            self.assertEqual(driver._client_pool.idle_count(), 1)
+
+            with open(path, 'w') as f:
+                f.write(CONFIG.replace('a.example.org', 'a2.example.org'))
+            stat = os.stat(path)
+            os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+            config = driver._get_location_config(site_a)
+            self.assertEqual(config['endpoint'], 'a2.example.org')
+            self.assertEqual(driver._client_pool.idle_count(), 0)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_marketplace_timer_covers_download(self):
+        metrics = HistogramMetrics()
+        driver = self.create_driver(stratuslab_metrics=metrics)
+        metadata = marketplace_metadata([('IMAGE-A', 'ubuntu')])
+
+        class SlowStream(StringIO):
+            def read(self, size=-1):
+                time.sleep(0.05)
+                return StringIO.read(self, size)
+
+        driver._fetch_marketplace_url = lambda url: SlowStream(metadata)
+        self.assertEqual(len(driver.list_images()), 1)
+
+        values = metrics.snapshot()[('marketplace', 'marketplace.stratuslab.eu')]
+        self.assertEqual(values['count'], 1)
+        self.assertEqual(values['errors'], 0)
+        self.assertTrue(values['sum'] >= 0.1)
+
+    def test_marketplace_download_errors_are_counted(self):
+        metrics = HistogramMetrics()
+        driver = self.create_driver(stratuslab_metrics=metrics)
+
+        class BrokenStream(StringIO):
+            def read(self, size=-1):
+                raise IOError('connection reset')
+
+        driver._fetch_marketplace_url = lambda url: BrokenStream()
+        self.assertRaises(IOError, list, driver.ex_iter_images())
+
+        values = metrics.snapshot()[('marketplace', 'marketplace.stratuslab.eu')]
+        self.assertEqual(values['count'], 1)
+        self.assertEqual(values['errors'], 1)
+
+    def test_registry_errors_do_not_break_listing(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            driver = self.create_driver(
+                stratuslab_registry=os.path.join(tmp_dir, 'registry.db'),
+                stratuslab_registry_reconcile=False)
+
+            def fail(*args):
+                raise IOError('disk full')
+            driver.registry.save_nodes = fail
+
+            CLOUD.vms['site-a'] = [vm_attrs(1)]
+            nodes = driver.list_nodes_in_location(driver.locations['site-a'])
+            self.assertEqual([node.id for node in nodes], ['1'])
+            self.assertEqual([r.id for r in driver.ex_list_cached_nodes(compact=True)], ['1'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from stratuslab.dirac.tracing import Tracer, TraceStore, JsonLinesExporter, NULL_SPAN
+
+
+class _ListExporter(object):
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+class TracingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.exporter = _ListExporter()
+        self.tracer = Tracer(self.exporter)
+
+    def test_children_share_trace_and_reference_parent(self):
+        root = self.tracer.start_span('instance', 'DiracId-1', siteName='site')
+        with root.child('create') as create:
+            pass
+        root.finish()
+
+        self.assertEqual([s.name for s in self.exporter.spans], ['create', 'instance'])
+        self.assertEqual(create.trace_id, 'DiracId-1')
+        self.assertEqual(create.parent_id, root.span_id)
+        self.assertEqual(root.parent_id, None)
+        self.assertEqual(root.attributes, {'siteName': 'site'})
+        self.assertTrue(root.duration >= create.duration)
+
+    def test_error_is_recorded_and_raised(self):
+        root = self.tracer.start_span('instance', 'DiracId-2')
+
+        def fail():
+            with root.child('contextualize'):
+                raise ValueError('no route to host')
+        self.assertRaises(ValueError, fail)
+
+        span = self.exporter.spans[0].to_dict()
+        self.assertEqual(span['status'], 'ERROR')
+        self.assertEqual(span['error'], 'no route to host')
+
+    def test_span_is_exported_once(self):
+        span = self.tracer.start_span('instance', 'DiracId-3')
+        span.finish()
+        span.finish(error='ignored')
+        self.assertEqual(len(self.exporter.spans), 1)
+        self.assertEqual(span.error, None)
+
+    def test_later_phases_are_linked_to_exported_root(self):
+        store = TraceStore()
+        root = self.tracer.start_span('instance', 'DiracId-5')
+        root.finish()
+        store.put(root)
+
+        # another client of the process, with its own tracer
+        other = Tracer(self.exporter)
+        trace = store.pop('DiracId-5')
+        other.start_span('terminate', trace.trace_id, parent_id=trace.span_id).finish()
+
+        terminate = self.exporter.spans[-1]
+        self.assertEqual(terminate.trace_id, 'DiracId-5')
+        self.assertEqual(terminate.parent_id, root.span_id)
+        self.assertEqual(terminate.attributes, {})
+        self.assertEqual(store.get('DiracId-5'), None)
+
+    def test_trace_store_discards_oldest_traces(self):
+        store = TraceStore(max_traces=10)
+        for i in range(25):
+            span = self.tracer.start_span('instance', 'DiracId-%d' % i)
+            span.start = i
+            store.put(span)
+        self.assertTrue(len(store) <= 10)
+        self.assertTrue(store.get('DiracId-24') is not None)
+        self.assertEqual(store.get('DiracId-0'), None)
+
+    def test_null_span(self):
+        with NULL_SPAN.child('sftp') as span:
+            span.set_attribute('publicIP', '127.0.0.1')
+        span.finish()
+
+    def test_json_lines_exporter(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'trace.jsonl')
+            tracer = Tracer(JsonLinesExporter(path))
+
+            root = tracer.start_span('instance', 'DiracId-4')
+            root.child('create').finish()
+            root.finish()
+
+            with open(path) as f:
+                spans = [json.loads(line) for line in f]
+
+            self.assertEqual([s['name'] for s in spans], ['create', 'instance'])
+            self.assertEqual(spans[0]['parent_id'], spans[1]['span_id'])
+            self.assertEqual(spans[1]['trace_id'], 'DiracId-4')
+            self.assertEqual(spans[1]['status'], 'OK')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -36,7 +36,7 @@ print
 # Large, node machine to run at GRNET.
 size = utils.select_id('m1.large', sizes)
 location = utils.select_id('grnet', locations)
-image = utils.select_id('BN1EEkPiBx87_uLj2-sdybSI-Xb', images)
+image = driver.get_image('BN1EEkPiBx87_uLj2-sdybSI-Xb')
 
 # Get ssh key.
 home = os.path.expanduser('~')
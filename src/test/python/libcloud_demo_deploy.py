@@ -35,7 +35,7 @@ print
 # Large, ubuntu machine to run at GRNET.
 size = utils.select_id('m1.large', sizes)
 location = utils.select_id('lal', locations)
-image = utils.select_id('GJ5vp8gIxhZ1w1MQF16R6MIcNoq', images)
+image = driver.get_image('GJ5vp8gIxhZ1w1MQF16R6MIcNoq')
 
 # Get ssh key.
 home = os.path.expanduser('~')
@@ -0,0 +1,245 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+In-memory replacements for the modules of the StratusLab client used
+by the Libcloud driver (Monitor, Runner, ConfigHolder, PersistentDisk,
+Util), so that the driver can be tested without a cloud.  Call
+install() before importing stratuslab.libcloud.compute_driver and
+uninstall() once the tests are done, so that other tests of the same
+process use the real modules.
+
+Each location (configuration section) has its own list of machines,
+given as dictionaries of Monitor attributes in CLOUD.vms.  The calls
+made to the services are recorded in CLOUD.calls.
+"""
+
+import ConfigParser
+import imp
+import sys
+import threading
+import time
+
+
+class FakeCloud(object):
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.vms = {}
+        self.delays = {}
+        self.errors = {}
+        self.calls = []
+        self.next_id = 100
+
+    def record(self, *call):
+        with self.lock:
+            self.calls.append(call)
+
+    def count(self, operation, location_id=None):
+        with self.lock:
+            return len([call for call in self.calls
+                        if call[0] == operation and
+                        (location_id is None or call[1] == location_id)])
+
+    def respond(self, location_id):
+        time.sleep(self.delays.get(location_id, 0))
+        error = self.errors.get(location_id)
+        if error is not None:
+            raise error
+
+
+CLOUD = FakeCloud()
+
+
+def vm_attrs(vm_id, state='Running', ip=None, name='vm', host='host-1',
+             image='IMAGE-A', cpu=1, memory=128, disk=1024, **extra):
+    """
+    Returns the Monitor attributes of a machine.
+    """
+    attrs = {'id': vm_id,
+             'name': name,
+             'state_summary': state,
+             'template_nic_ip': ip,
+             'history_records_history_hostname': host,
+             'template_disk_source': 'https://marketplace.example.org/metadata/%s' % image,
+             'template_cpu': cpu,
+             'template_memory': memory,
+             'template_disk_size': disk}
+    attrs.update(extra)
+    return attrs
+
+
+class VmInfo(object):
+
+    def __init__(self, attrs):
+        self.attrs = attrs
+
+    def getAttributes(self):
+        return dict(self.attrs)
+
+
+class Monitor(object):
+
+    def __init__(self, configHolder):
+        self.location_id = configHolder.config.get('_section')
+        CLOUD.record('Monitor', self.location_id)
+
+    def listVms(self):
+        CLOUD.record('listVms', self.location_id)
+        CLOUD.respond(self.location_id)
+        return [VmInfo(attrs) for attrs in CLOUD.vms.get(self.location_id, [])]
+
+    def vmDetail(self, ids):
+        CLOUD.record('vmDetail', self.location_id, tuple(ids))
+        CLOUD.respond(self.location_id)
+        ids = [str(vm_id) for vm_id in ids]
+        return [VmInfo(attrs) for attrs in CLOUD.vms.get(self.location_id, [])
+                if str(attrs['id']) in ids]
+
+
+class Runner(object):
+
+    def __init__(self, image, configHolder):
+        self.image = image
+        self.configHolder = configHolder
+
+    @staticmethod
+    def getDefaultInstanceTypes():
+        return {'m1.small': (1, 128, 1024),
+                'm1.large': (2, 512, 1024)}
+
+    @staticmethod
+    def defaultRunOptions():
+        return {'verboseLevel': 0,
+                'vmTemplateFile': 'template',
+                'marketplaceEndpoint': 'https://marketplace.example.org',
+                'vmRequirements': '',
+                'outVmIdsFile': '',
+                'inVmIdsFile': '',
+                'instanceNumber': 1}
+
+    def runInstance(self):
+        location_id = self.configHolder.config.get('_section')
+        count = int(self.configHolder.options.get('instanceNumber', 1))
+        CLOUD.record('runInstance', location_id, count)
+        CLOUD.respond(location_id)
+        ids = []
+        with CLOUD.lock:
+            for _ in range(count):
+                ids.append(str(CLOUD.next_id))
+                CLOUD.next_id += 1
+        return ids
+
+    def killInstances(self, ids):
+        location_id = self.configHolder.config.get('_section')
+        CLOUD.record('killInstances', location_id, tuple(ids))
+        CLOUD.respond(location_id)
+
+
+class ConfigHolder(object):
+
+    def __init__(self, options=None, config=None, context=None):
+        self.options = options or {}
+        self.config = config or {}
+
+    def set(self, key, value):
+        self.options[key] = value
+
+
+class UserConfigurator(object):
+
+    def __init__(self, configFile):
+        self._parser = ConfigParser.SafeConfigParser()
+        if hasattr(configFile, 'readline'):
+            configFile.seek(0)
+            self._parser.readfp(configFile)
+        else:
+            self._parser.read(configFile)
+
+    @staticmethod
+    def userConfiguratorToDictWithFormattedKeys(user_configurator,
+                                                selected_section=None):
+        parser = user_configurator._parser
+        config = dict(parser.items('default'))
+        if selected_section and parser.has_section(selected_section):
+            config.update(parser.items(selected_section))
+        config['_section'] = selected_section
+        return config
+
+    def getUserDefinedInstanceTypes(self):
+        return {}
+
+
+class PersistentDisk(object):
+
+    def __init__(self, configHolder):
+        self.configHolder = configHolder
+
+
+def _module(name, **attributes):
+    module = imp.new_module(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+_CLIENT_MODULES = [
+    ('Monitor', {'Monitor': Monitor}),
+    ('Runner', {'Runner': Runner}),
+    ('ConfigHolder', {'ConfigHolder': ConfigHolder,
+                      'UserConfigurator': UserConfigurator}),
+    ('PersistentDisk', {'PersistentDisk': PersistentDisk}),
+    ('Util', {'defaultConfigFileUser': None})]
+
+
+def install(dependents=()):
+    """
+    Replaces the StratusLab client modules used by the driver with
+    the stubs of this module.  The dependent modules (those importing
+    the client modules, e.g. 'stratuslab.libcloud.compute_driver') are
+    unloaded, so that importing them again binds the stubs.  Returns
+    the replaced modules, to be passed to uninstall().
+    """
+    import stratuslab
+
+    saved = {}
+    for name in list(dependents):
+        saved[name] = sys.modules.pop(name, None)
+
+    for name, attributes in _CLIENT_MODULES:
+        saved['stratuslab.' + name] = sys.modules.get('stratuslab.' + name)
+        setattr(stratuslab, name, _module('stratuslab.' + name, **attributes))
+
+    return saved
+
+
+def uninstall(saved):
+    """
+    Restores the modules replaced or unloaded by install().
+    """
+    for name, module in saved.items():
+        package_name, _, attribute = name.rpartition('.')
+        package = sys.modules.get(package_name)
+        if module is None:
+            sys.modules.pop(name, None)
+            if package is not None and hasattr(package, attribute):
+                delattr(package, attribute)
+        else:
+            sys.modules[name] = module
+            if package is not None:
+                setattr(package, attribute, module)